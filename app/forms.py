@@ -1,8 +1,11 @@
 from django import forms
 
+from .haploutils import GZIP, ZSTD, zstandard
+
 OPERATION_CHOICES = (
     ("S2H", "Sequences -> Haplotypes"),
     ("H2S", "Haplotypes -> Sequences"),
+    ("H2D", "Haplotypes -> Distance matrix"),
 )
 
 NOMENCLATURE_CHOICES = (
@@ -10,6 +13,13 @@ NOMENCLATURE_CHOICES = (
     ("FOR", "Forensic genetics"),
 )
 
+COMPRESSION_CHOICES = (
+    ("", "None"),
+    (GZIP, "gzip (.gz)"),
+)
+if zstandard is not None:
+    COMPRESSION_CHOICES += ((ZSTD, "zstd (.zst)"),)
+
 
 class HaploSearchForm(forms.Form):
     inputfile = forms.FileField()
@@ -21,3 +31,21 @@ class HaploSearchForm(forms.Form):
         required=False,
         help_text="HVRI haplotypes with three-digits mutation"
     )
+    compression = forms.ChoiceField(
+        label="Output compression",
+        choices=COMPRESSION_CHOICES,
+        required=False,
+        help_text="Compressed input files (gzip or zstd) are also accepted"
+    )
+    compact = forms.BooleanField(
+        label="Compact output",
+        initial=False,
+        required=False,
+        help_text="Reference stored once plus the changes of each sequence"
+    )
+    max_distance = forms.IntegerField(
+        label="Maximum distance",
+        min_value=0,
+        required=False,
+        help_text="Only the pairs of samples this close (empty: full matrix)"
+    )
@@ -1,13 +1,41 @@
 from .exceptions import HaploException
+import gzip
+import hashlib
+import io
+import mmap
+import os
+import pickle
+import struct
+import time
+import tracemalloc
 import re
+from array import array
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+from itertools import islice
+from multiprocessing import Pool
+from tempfile import NamedTemporaryFile, SpooledTemporaryFile
 from .utils import listtoranges
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # definición de las bases
 ADENINA = "A"
 TIMINA = "T"
 GUANINA = "G"
 CITOSINA = "C"
 BLANCO = "-"
+BLANCO_B = BLANCO.encode("ascii")
+HUECO = ord(BLANCO)
 # códigos de la IUPAC
 ADEoGUA = "R"
 CIToTIM = "Y"
@@ -28,112 +56,266 @@ INSERTION = "I"
 DELETION = "D"
 MISSING = "M"
 HETEROPLASMY = "H"
+IDENTITY = "="
+
+# bases nucleotídicas y códigos de heteroplasmia
+BASES = ADENINA + TIMINA + GUANINA + CITOSINA
+HETEROPLASMIAS = (
+    ADEoGUA + CIToTIM + GUAoCIT + ADEoTIM + GUAoTIM + ADEoCIT +
+    CIToGUAoTIM + ADEoGUAoTIM + ADEoCIToTIM + ADEoCIToGUA + ANYBASE
+)
+BASE_TRANSICION = {
+    CITOSINA: TIMINA, TIMINA: CITOSINA,
+    ADENINA: GUANINA, GUANINA: ADENINA,
+}
+TRANSICIONES = set(BASE_TRANSICION.items())
+
+
+def tipo_cambio(ref_base, base):
+    """
+    Función que clasifica el cambio entre una base de referencia y la base de
+    una secuencia en la misma columna.
+    Parámetros:
+      ref_base: base de la secuencia de referencia.
+      base: base de la secuencia.
+    Retorna:
+      el tipo de cambio (TRANSITION, TRANSVERSION, HETEROPLASMY, INSERTION,
+      DELETION, MISSING ó IDENTITY).
+    """
+    if ((ref_base, base) in TRANSICIONES):
+        return TRANSITION
+    elif (ref_base in BASES and base in BASES and ref_base != base):
+        return TRANSVERSION
+    elif (base in HETEROPLASMIAS):
+        return HETEROPLASMY
+    elif (ref_base == BLANCO and base in BASES):
+        return INSERTION
+    elif (ref_base in BASES and base == BLANCO):
+        return DELETION
+    elif (base not in BASES and base != BLANCO):
+        return MISSING
+    return IDENTITY
+
+
+# códigos de los tipos de cambio para el motor por lotes (IDENTITY es el 0)
+CODIGOS_CAMBIO = (
+    IDENTITY, TRANSITION, TRANSVERSION, HETEROPLASMY, INSERTION, DELETION,
+    MISSING,
+)
+# número de secuencias que el motor por lotes clasifica a la vez
+BATCH_SIZE = 512
+# tamaño a partir del cual las mutaciones pendientes se vuelcan a disco
+SPOOL_SIZE = 8 * 1024 * 1024
+PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL
+# tamaño del buffer de escritura de los ficheros de salida
+OUTPUT_BUFFER = 1024 * 1024
+# bytes leídos de un fichero proyectado tras los que se liberan sus páginas
+MAPPED_RELEASE = 8 * 1024 * 1024
+# compresión de los ficheros de entrada y salida
+GZIP = "gz"
+ZSTD = "zst"
+MAGIC_GZIP = b"\x1f\x8b"
+MAGIC_ZSTD = b"\x28\xb5\x2f\xfd"
+COMPRESS_LEVEL = 6
+# cabecera de la salida compacta de H2S
+COMPACT_HEADER = "COMPACT: 1\n"
+# caché en disco de referencias alineadas: tamaño máximo y cabecera de cada
+# fichero (marca, número de columnas, número de posiciones)
+REFCACHE_SIZE = 64 * 1024 * 1024
+REFCACHE_HEADER = struct.Struct("<4sII")
+REFCACHE_MAGIC = b"HSR1"
+# temporales de la caché a medio escribir, y segundos tras los que se
+# consideran abandonados (por una escritura interrumpida)
+REFCACHE_TMP_PREFIX = "ref-"
+REFCACHE_TMP_SUFFIX = ".tmp"
+REFCACHE_TMP_AGE = 60 * 60
+# número de registros que se envían de una vez a cada proceso de conversión
+CHUNK_SIZE = 64
+# número de registros distintos que recuerda cada conversor
+MEMO_SIZE = 1024
+# filas de la matriz de distancias que se calculan y escriben a la vez, y
+# memoria máxima (bytes) de los bitsets que se comparan de una vez
+DISTANCE_TILE = 256
+DISTANCE_BLOCK_BYTES = 4 * 1024 * 1024
+
+# tabla precalculada (base de referencia, base) -> tipo de cambio
+TABLA_CAMBIOS = {
+    (r, b): tipo_cambio(r, b)
+    for r in BASES + BLANCO + HETEROPLASMIAS
+    for b in BASES + BLANCO + HETEROPLASMIAS
+}
+
+# tamaño de los bloques que se comparan de una vez al buscar diferencias
+BLOQUE = 64
+
+
+def diff_columns(a, b, block=BLOQUE):
+    """
+    Función que obtiene las columnas en las que difieren dos cadenas de la
+    misma longitud. Se comparan bloques completos y sólo se recorren carácter
+    a carácter aquellos que no son iguales.
+    Parámetros:
+      a: primera cadena.
+      b: segunda cadena.
+      block: tamaño del bloque de comparación.
+    Retorna:
+      lista ordenada con las columnas distintas.
+    """
+    cols = []
+    n = len(a)
+    for ini in range(0, n, block):
+        fin = ini + block
+        if (a[ini:fin] != b[ini:fin]):
+            for i in range(ini, min(fin, n)):
+                if (a[i] != b[i]):
+                    cols.append(i)
+    return cols
+
+
+# caracteres de las notaciones de mutación
+DIGITOS = "0123456789"
+CODIGOS_IUPAC = BASES + HETEROPLASMIAS
+
+# mutación separada en tipo, posición, desplazamiento y bases
+Mutation = namedtuple("Mutation", ["type", "position", "offset", "base"])
+# número de notaciones distintas que se recuerdan ya separadas
+MUTATION_CACHE_SIZE = 4096
 
 
+@lru_cache(maxsize=MUTATION_CACHE_SIZE)
 def split_mutation_population(mutation):
     """
-    Método que separa una mutación en tipo, posición y bases. Se devuelve en un
-    diccionario.
+    Método que separa una mutación en tipo, posición y bases. Se devuelve una
+    Mutation cuyo desplazamiento es siempre 0.
     Para el caso de las transiciones y transversiones siempre se devolverá un
     único tipo, posición y base; para el caso de las deleciones e inserciones
     se podrían devolver más de una base, lo que llevaría a que la posición que
     se devuelve es la correspondiente a la primera base.
+    La mutación se reconoce en una sola pasada: la posición son los dígitos
+    iniciales y el resto determina la notación.
     Se utiliza la nomenclatura de genética de poblaciones.
     """
-    # diccionario que vamos a retornar
-    d = {}
-    # el elemento es una transición
-    m = re.compile(r"^\d+$").match(mutation)
-    if (m):
-        d["type"] = TRANSITION
-        d["position"] = int(m.group(0))
-        d["base"] = ""
-    else:
+    resto = mutation.lstrip(DIGITOS)
+    digitos = len(mutation) - len(resto)
+    if (digitos > 0):
+        pos = int(mutation[:digitos])
+        # el elemento es una transición
+        if (not resto):
+            return Mutation(TRANSITION, pos, 0, "")
         # el elemento es una transversión
-        m = re.compile(r"^(\d+)([ATGCRYSWKMBDHVN])$").match(mutation)
-        if (m):
-            d["type"] = TRANSVERSION
-            d["position"] = int(m.group(1))
-            d["base"] = m.group(2)
-        else:
-            # el elemento es una inserción
-            m = re.compile(r"^(\d+)i([ATGC]+)$").match(mutation)
-            if (m):
-                d["type"] = INSERTION
-                d["position"] = int(m.group(1))
-                d["base"] = m.group(2)
-            else:
-                # el elemento es una deleción
-                m = re.compile(r"^(\d+)d([ATGC]+)$").match(mutation)
-                if (m):
-                    d["type"] = DELETION
-                    d["position"] = int(m.group(1))
-                    d["base"] = m.group(2)
-                else:
-                    raise HaploException(f"Unknown notation: {mutation}")
-    # retornamos el diccionario
-    return d
+        if (len(resto) == 1 and resto in CODIGOS_IUPAC):
+            return Mutation(TRANSVERSION, pos, 0, resto)
+        # el elemento es una inserción ó una deleción
+        bases = resto[1:]
+        if (bases and not bases.strip(BASES)):
+            if (resto[0] == "i"):
+                return Mutation(INSERTION, pos, 0, bases)
+            elif (resto[0] == "d"):
+                return Mutation(DELETION, pos, 0, bases)
+    raise HaploException(f"Unknown notation: {mutation}")
 
 
+@lru_cache(maxsize=MUTATION_CACHE_SIZE)
 def split_mutation_forensic(mutation):
     """
-    Método que separa una mutación en tipo, posición y bases. Se devuelve en un
-    diccionario.
+    Método que separa una mutación en tipo, posición, desplazamiento y bases.
+    Se devuelve una Mutation.
     Para el caso de las transiciones y transversiones siempre se devolverá un
     único tipo, posición y base; para el caso de las deleciones e inserciones
     se podrían devolver más de una base, lo que llevaría a que la posición que
     se devuelve es la correspondiente a la primera base.
+    La mutación se reconoce en una sola pasada: la posición son los dígitos
+    iniciales y el resto determina la notación.
     Se utiliza la nomenclatura forense.
     """
-    # diccionario que vamos a retornar
-    d = {}
-    # el elemento puede ser una transición, una transversión ó una
-    # heteroplasmia, pero a nuestros efectos, la consideramos como transversión
-    m = re.compile(r"^(\d+)([ATGCRYSWKMBDHVN])$").match(mutation)
-    if (m):
-        d["type"] = TRANSVERSION
-        d["position"] = int(m.group(1))
-        d["offset"] = 0
-        d["base"] = m.group(2)
-    else:
+    resto = mutation.lstrip(DIGITOS)
+    digitos = len(mutation) - len(resto)
+    if (digitos > 0):
+        pos = int(mutation[:digitos])
+        # el elemento puede ser una transición, una transversión ó una
+        # heteroplasmia, pero a nuestros efectos, la consideramos como
+        # transversión
+        if (len(resto) == 1 and resto in CODIGOS_IUPAC):
+            return Mutation(TRANSVERSION, pos, 0, resto)
+        # el elemento es una deleción; no conocemos la base, así que ponemos
+        # un hueco
+        if (resto == "d" or resto == "del"):
+            return Mutation(DELETION, pos, 0, BLANCO)
         # el elemento es una inserción
-        m = re.compile(r"^(\d+)\.(\d+)([ATGC])$").match(mutation)
-        if (m):
-            d["type"] = INSERTION
-            d["position"] = int(m.group(1))
-            d["offset"] = int(m.group(2))
-            d["base"] = m.group(3)
-        else:
-            # el elemento es una deleción
-            m = re.compile(r"^(\d+)(del|d)$").match(mutation)
-            if (m):
-                d["type"] = DELETION
-                d["position"] = int(m.group(1))
-                d["offset"] = 0
-                # no conocemos la base, así que ponemos missing
-                d["base"] = BLANCO
+        offset, base = resto[1:-1], resto[-1:]
+        if (resto[:1] == "." and offset and not offset.strip(DIGITOS) and
+                len(base) == 1 and base in BASES):
+            return Mutation(INSERTION, pos, int(offset), base)
+    raise HaploException(f"Unknown notation: {mutation}")
+
+
+def split_haplotype(haplotipo, ref_id, nomenclature):
+    """
+    Función que separa un haplotipo en la lista de sus mutaciones.
+    Parámetros:
+      haplotipo: haplotipo de la secuencia.
+      ref_id: identificación de la secuencia de referencia; si el haplotipo
+      coincide con ella es que es la misma y no hay cambios.
+      nomenclature: tipo de nomenclatura (poblaciones ó forense).
+    Retorna:
+      lista con las mutaciones del haplotipo.
+    """
+    if (haplotipo == ref_id):
+        return []
+    if (nomenclature == "POP"):
+        split_mutation = split_mutation_population
+    else:
+        split_mutation = split_mutation_forensic
+    return [split_mutation(h) for h in haplotipo.split()]
+
+
+def add_insertions(insertions, mutations, nomenclature):
+    """
+    Función que actualiza, con las inserciones de una lista de mutaciones,
+    el número de huecos necesarios tras cada posición.
+    Parámetros:
+      insertions: diccionario posición -> número de huecos necesarios.
+      mutations: lista de mutaciones de un haplotipo.
+      nomenclature: tipo de nomenclatura (poblaciones ó forense).
+    """
+    for m in mutations:
+        if (m.type == INSERTION):
+            # en nomenclatura de poblaciones la inserción trae todas sus bases
+            # y en la forense cada base indica su desplazamiento
+            if (nomenclature == "POP"):
+                n = len(m.base)
             else:
-                raise HaploException(f"Unknown notation: {mutation}")
-    # retornamos el diccionario
-    return d
+                n = m.offset
+            insertions[m.position] = max(insertions.get(m.position, 0), n)
 
 
 class Adn:
     """
     Clase que representa una secuencia de ADN.
+    La secuencia se guarda como un bytearray (un byte por base) y las
+    posiciones de referencia como arrays de enteros de 32 bits.
     """
 
+    __slots__ = ("id", "sec", "posbase", "posref", "posidx", "mutations")
+
     def __init__(self, id, sec):
         """
         Constructor de la clase.
         Se construye un objeto de ADN a partir de la secuencia de nucleotidos
         Parámetros:
             id: identificación de la secuencia
-            sec: cadena de caracteres con las bases de la secuencia
+            sec: cadena de caracteres (ó bytes) con las bases de la secuencia
         """
         self.id = id
-        self.sec = list(sec[:])
-        self.posref = []
+        if (isinstance(sec, str)):
+            sec = sec.encode("ascii")
+        self.sec = bytearray(sec)
+        self.posbase = 0
+        # posición de referencia de cada columna de la secuencia
+        self.posref = array("i")
+        # índice posición de referencia (desde posbase) -> primera columna de
+        # la secuencia
+        self.posidx = array("i")
         self.mutations = []
 
     @classmethod
@@ -148,58 +330,56 @@ class Adn:
           ref: secuencia de referencia (normalmente rCRS)
           haplotipo: haplotipo de la nueva secuencia
         """
-        # lista de mutaciones, en principio vacía
-        mutations = []
+        mutations = split_haplotype(haplotipo, ref.id, "POP")
+        return cls.from_mutations_population(id, ref, mutations)
+
+    @classmethod
+    def from_mutations_population(cls, id, ref, mutations):
+        """
+        Constructor "alternativo" de la clase.
+        Se construye un objeto de ADN a partir de las mutaciones, ya
+        separadas, de un haplotipo sobre una referencia.
+        Se utiliza la nomenclatura de genética de poblaciones.
+        Parámetros:
+          id: identificación de la secuencia
+          ref: secuencia de referencia (normalmente rCRS)
+          mutations: lista de mutaciones de la nueva secuencia
+        """
         # en principio, la secuencia es la misma que la referencia
-        sec = ref[:]
-        # si el haplotipo coincide con la denominación de la referencia es que
-        # es la misma y no hay cambios
-        if (ref.id != haplotipo):
-            # dividimos el haplotipo por los espacios
-            haplo_lista = haplotipo.split()
-            # recorremos los diferentes elementos del haplotipo
-            for h in haplo_lista:
-                try:
-                    m = split_mutation_population(h)
-                except HaploException as err:
-                    raise err
-                # guardamos la mutación
-                mutations.append(m)
-                # el elemento es una transición
-                if (m["type"] == TRANSITION):
-                    pos = ref.posref.index(int(m["position"]))
-                    if (ref[pos] == TIMINA):
-                        m["base"] = sec[pos] = CITOSINA
-                    elif (ref[pos] == CITOSINA):
-                        m["base"] = sec[pos] = TIMINA
-                    elif (ref[pos] == ADENINA):
-                        m["base"] = sec[pos] = GUANINA
-                    elif (ref[pos] == GUANINA):
-                        m["base"] = sec[pos] = ADENINA
-                # el elemento es una transversión
-                elif (m["type"] == TRANSVERSION):
-                    pos = ref.posref.index(int(m["position"]))
-                    base = m["base"]
-                    sec[pos] = base
-                # el elemento es una inserción
-                elif (m["type"] == INSERTION):
-                    pos = ref.posref.index(int(m["position"])) + 1
-                    # iteramos por si hay más de una base
-                    for b in m["base"]:
-                        sec[pos] = b
-                        pos = pos + 1
-                elif (m["type"] == DELETION):
-                    pos = ref.posref.index(int(m["position"]))
-                    # iteramos por si hay más de una base
-                    for b in m["base"]:
-                        sec[pos] = BLANCO
-                        pos = pos + 1
-                # si entramos por este último else es que lo que aparece en la
-                # entrada es incorrecto
-                else:
-                    raise HaploException(f"Unknown notation: {h}")
+        sec = bytearray(ref.sec)
+        # recorremos las diferentes mutaciones del haplotipo
+        for k, m in enumerate(mutations):
+            # el elemento es una transición
+            if (m.type == TRANSITION):
+                pos = ref.column(m.position)
+                base = BASE_TRANSICION.get(ref[pos])
+                if (base):
+                    sec[pos] = ord(base)
+                    # guardamos la base resultante de la transición
+                    mutations[k] = m._replace(base=base)
+            # el elemento es una transversión
+            elif (m.type == TRANSVERSION):
+                pos = ref.column(m.position)
+                sec[pos] = ord(m.base)
+            # el elemento es una inserción
+            elif (m.type == INSERTION):
+                pos = ref.column(m.position, 1)
+                # iteramos por si hay más de una base
+                for b in m.base.encode("ascii"):
+                    sec[pos] = b
+                    pos = pos + 1
+            elif (m.type == DELETION):
+                pos = ref.column(m.position)
+                # iteramos por si hay más de una base
+                for b in m.base:
+                    sec[pos] = HUECO
+                    pos = pos + 1
+            # si entramos por este último else es que lo que aparece en la
+            # entrada es incorrecto
+            else:
+                raise HaploException(f"Unknown notation: {m}")
         # creamos el nuevo objeto
-        s = cls(id, "".join(sec))
+        s = cls(id, sec)
         # le asociamos las mutaciones
         s.mutations = mutations
         # retornamos la secuencia
@@ -217,26 +397,28 @@ class Adn:
           ref: secuencia de referencia (normalmente rCRS)
           haplotipo: haplotipo de la nueva secuencia
         """
-        # lista de mutaciones, en principio vacía
-        mutations = []
+        mutations = split_haplotype(haplotipo, ref.id, "FOR")
+        return cls.from_mutations_forensic(id, ref, mutations)
+
+    @classmethod
+    def from_mutations_forensic(cls, id, ref, mutations):
+        """
+        Constructor "alternativo" de la clase.
+        Se construye un objeto de ADN a partir de las mutaciones, ya
+        separadas, de un haplotipo sobre una referencia.
+        Se utiliza la nomenclatura forense.
+        Parámetros:
+          id: identificación de la secuencia
+          ref: secuencia de referencia (normalmente rCRS)
+          mutations: lista de mutaciones de la nueva secuencia
+        """
         # en principio, la secuencia es la misma que la referencia
-        sec = ref[:]
-        # si el haplotipo coincide con la denominación de la referencia es que
-        # es la misma y no hay cambios
-        if (ref.id != haplotipo):
-            # dividimos el haplotipo por los espacios
-            haplo_lista = haplotipo.split()
-            # recorremos los diferentes elementos del haplotipo
-            for h in haplo_lista:
-                try:
-                    m = split_mutation_forensic(h)
-                except HaploException as err:
-                    raise err
-                mutations.append(m)
-                pos = ref.posref.index(m["position"]) + m["offset"]
-                sec[pos] = m["base"]
+        sec = bytearray(ref.sec)
+        for m in mutations:
+            pos = ref.column(m.position, m.offset)
+            sec[pos] = ord(m.base)
         # creamos el nuevo objeto
-        s = cls(id, "".join(sec))
+        s = cls(id, sec)
         # le asociamos las mutaciones
         s.mutations = mutations
         # retornamos la secuencia
@@ -245,48 +427,72 @@ class Adn:
     def build_positions(self, posbase):
         """
         Función para construir las posiciones en base a una secuencia de
-        referencia y una posición inicial.
+        referencia y una posición inicial. Las columnas se recorren por
+        tramos de bases y de huecos consecutivos.
         Parámetros:
-          ref: secuencia de referencia
           posbase: posición base de la secuencia de referencia
-        Retorna:
-          i: lista de posiciones en base a la secuencia
         """
-        # inicializar la lista a vacío
-        self.posref = []
+        n = len(self.sec)
+        self.posbase = posbase
+        # colocamos la posición inicial
+        self.posref = array("i", [posbase])
+        self.posidx = array("i", [0])
         # contador auxiliar
         c = posbase
-        # colocamos la posición inicial
-        self.posref.append(c)
-        # recorremos el resto de elementos
-        for s in self.sec[1:]:
-            if (s == BLANCO):
-                self.posref.append(c)
-            else:
-                c = c + 1
-                self.posref.append(c)
+        i = 1
+        while (i < n):
+            # tramo de bases hasta el siguiente hueco
+            j = self.sec.find(HUECO, i)
+            if (j == -1):
+                j = n
+            self.posref.extend(range(c + 1, c + 1 + j - i))
+            self.posidx.extend(range(i, j))
+            c = c + j - i
+            # tramo de huecos, que comparten la posición de la base anterior
+            i = j
+            while (i < n and self.sec[i] == HUECO):
+                i = i + 1
+            self.posref.extend(array("i", [c]) * (i - j))
+
+    def column(self, position, offset=0):
+        """
+        Obtener la columna de la secuencia asociada a una posición de
+        referencia. Las columnas de inserción se alcanzan mediante el
+        desplazamiento.
+        Parámetros:
+          position: posición de referencia
+          offset: desplazamiento sobre la primera columna de la posición
+        """
+        k = position - self.posbase
+        if (k < 0 or k >= len(self.posidx)):
+            raise HaploException(f"Position out of reference: {position}")
+        return self.posidx[k] + offset
 
     # Imprimir la secuencia
     def __str__(self):
-        return ">%s\n%s" % (self.id, "".join(self.sec))
+        return ">%s\n%s" % (self.id, self.getseq_asstring())
 
     # Imprimir la secuencia sin huecos
     def versinhuecos(self):
-        return ">%s\n%s" % (self.id, "".join(self.sec).replace(BLANCO, ""))
+        return ">%s\n%s" % (
+            self.id, self.sec.replace(BLANCO_B, b"").decode("ascii")
+        )
 
     def getseq_asstring(self):
         """
         Función que devuelve la secuencia de ADN como un string.
         """
-        return "".join(self.sec)
+        return self.sec.decode("ascii")
 
     def __getitem__(self, position):
         """
-        Obtener una base de la secuencia.
+        Obtener una base (ó un tramo) de la secuencia como cadena.
         Parámetros:
           position: posición que se quiere buscar
         """
-        return self.sec[position]
+        if (isinstance(position, slice)):
+            return self.sec[position].decode("ascii")
+        return chr(self.sec[position])
 
     def __len__(self):
         """
@@ -294,6 +500,29 @@ class Adn:
         """
         return len(self.sec)
 
+    def diff_columns(self, ref):
+        """
+        Obtener las columnas en las que la secuencia difiere de la de
+        referencia.
+        Parámetros:
+          ref: secuencia de referencia.
+        """
+        return diff_columns(self.sec, ref.sec)
+
+    def classify(self, ref, cols):
+        """
+        Obtener el tipo de cambio de cada una de las columnas indicadas
+        respecto a la secuencia de referencia.
+        Parámetros:
+          ref: secuencia de referencia.
+          cols: columnas a clasificar.
+        """
+        cambios = []
+        for i in cols:
+            r, b = ref[i], self[i]
+            cambios.append(TABLA_CAMBIOS.get((r, b)) or tipo_cambio(r, b))
+        return cambios
+
     def haplotype_population(self, ref, hvri):
         """
         Obtener el haplotipo de la secuencia actual en comparación con una de
@@ -306,113 +535,74 @@ class Adn:
         Retorna:
             Una cadena con la representación del haplotipo.
         """
-        # posición de la secuencia
-        i = 0
+        # sólo se tienen en cuenta las columnas en las que difieren las dos
+        # secuencias (se presupone que tienen el mismo tamaño y que la
+        # referencia sólo contiene bases y huecos)
+        cols = self.diff_columns(ref)
+        return self.render_population(ref, cols, self.classify(ref, cols), hvri)
+
+    def render_population(self, ref, cols, cambios, hvri):
+        """
+        Construir el haplotipo en nomenclatura de genética de poblaciones a
+        partir de las columnas distintas de la referencia y sus cambios.
+        Parámetros:
+            ref: secuencia de referencia.
+            cols: columnas ordenadas en las que la secuencia difiere.
+            cambios: tipo de cambio de cada columna.
+            hvri: indica si los haplotipos se muestran con 3 dígitos o
+            normales.
+        Retorna:
+            Una cadena con la representación del haplotipo.
+        """
+        # formato de las posiciones
+        fp = "%03d" if hvri else "%d"
         # lista para guardar los valores missing
         missing = []
         # hay que llevar cuenta del último cambio registrado
-        ultimo_cambio = -1
-        # haplotipo
-        h = ""
-        # recorremos los elementos de las dos secuencias
-        # se presupone que tienen el mismo tamaño
-        while (i < len(self)):
+        ultimo_cambio = IDENTITY
+        # última columna distinta visitada
+        anterior = -2
+        # fragmentos del haplotipo, que se unen al final
+        h = []
+        # una columna no contigua a la anterior implica que entre ambas no
+        # hubo cambios
+        for i, cambio in zip(cols, cambios):
+            if (i != anterior + 1):
+                ultimo_cambio = IDENTITY
+            anterior = i
+            r, b = ref[i], self[i]
             # posición actual de referencia
             pos = ref.posref[i]
-            # TRANSICIONES
-            if (((ref[i] == CITOSINA) and (self[i] == TIMINA)) or
-                    ((ref[i] == TIMINA) and (self[i] == CITOSINA)) or
-                    ((ref[i] == ADENINA) and (self[i] == GUANINA)) or
-                    ((ref[i] == GUANINA) and (self[i] == ADENINA))):
-                if hvri:
-                    h = h + (" %03d" % (pos))
-                else:
-                    h = h + (" %d" % (pos))
-                ultimo_cambio = TRANSITION
-            # TRANSVERSIONES
-            elif (((ref[i] == ADENINA) and (self[i] == TIMINA)) or
-                  ((ref[i] == TIMINA) and (self[i] == ADENINA)) or
-                  ((ref[i] == ADENINA) and (self[i] == CITOSINA)) or
-                  ((ref[i] == CITOSINA) and (self[i] == ADENINA)) or
-                  ((ref[i] == GUANINA) and (self[i] == TIMINA)) or
-                  ((ref[i] == TIMINA) and (self[i] == GUANINA)) or
-                  ((ref[i] == GUANINA) and (self[i] == CITOSINA)) or
-                  ((ref[i] == CITOSINA) and (self[i] == GUANINA))):
-                if hvri:
-                    h = h + (" %03d%s" % (pos, self[i]))
-                else:
-                    h = h + (" %d%s" % (pos, self[i]))
-                ultimo_cambio = TRANSVERSION
-            # HETEROPLASMIAS
-            elif ((self[i] == ADEoGUA) or
-                  (self[i] == ADEoGUA) or
-                  (self[i] == CIToTIM) or
-                  (self[i] == GUAoCIT) or
-                  (self[i] == ADEoTIM) or
-                  (self[i] == GUAoTIM) or
-                  (self[i] == ADEoCIT) or
-                  (self[i] == CIToGUAoTIM) or
-                  (self[i] == ADEoGUAoTIM) or
-                  (self[i] == ADEoCIToTIM) or
-                  (self[i] == ADEoCIToGUA) or
-                  (self[i] == ANYBASE)):
-                if hvri:
-                    h = h + (" %03d%s" % (pos, self[i]))
-                else:
-                    h = h + (" %d%s" % (pos, self[i]))
-                ultimo_cambio = HETEROPLASMY
-            # INSERCIONES
-            elif (((ref[i] == BLANCO) and (self[i] == TIMINA)) or
-                  ((ref[i] == BLANCO) and (self[i] == ADENINA)) or
-                  ((ref[i] == BLANCO) and (self[i] == GUANINA)) or
-                  ((ref[i] == BLANCO) and (self[i] == CITOSINA))):
-                # si el último cambio no fue una inserción, empezamos una nueva
-                if (ultimo_cambio != INSERTION):
-                    if hvri:
-                        h = h + (" %03di%s" % (pos, self[i]))
-                    else:
-                        h = h + (" %di%s" % (pos, self[i]))
+            if (cambio == TRANSITION):
+                h.append(" " + fp % (pos))
+            elif (cambio == TRANSVERSION or cambio == HETEROPLASMY):
+                h.append(" " + fp % (pos) + b)
+            elif (cambio == INSERTION):
                 # si el último cambio fue una inserción, la agrupamos con la
-                # anterior
+                # anterior; en otro caso empezamos una nueva
+                if (ultimo_cambio == INSERTION):
+                    h.append(b)
                 else:
-                    h = h + ("%s" % (self[i]))
-                ultimo_cambio = INSERTION
-            # DELECIONES
-            elif (((ref[i] == TIMINA) and (self[i] == BLANCO)) or
-                  ((ref[i] == ADENINA) and (self[i] == BLANCO)) or
-                  ((ref[i] == GUANINA) and (self[i] == BLANCO)) or
-                  ((ref[i] == CITOSINA) and (self[i] == BLANCO))):
-                # si el último cambio no fue una deleción, empezamos una nueva
-                if (ultimo_cambio != DELETION):
-                    if hvri:
-                        h = h + (" %03dd%s" % (pos, ref[i]))
-                    else:
-                        h = h + (" %dd%s" % (pos, ref[i]))
+                    h.append(" " + fp % (pos) + "i" + b)
+            elif (cambio == DELETION):
+                # igual que con las inserciones, agrupamos las deleciones
+                # consecutivas
+                if (ultimo_cambio == DELETION):
+                    h.append(r)
                 else:
-                    h = h + ("%s" % (ref[i]))
-                ultimo_cambio = DELETION
-            # MISSING
-            elif ((self[i] != TIMINA) and
-                  (self[i] != ADENINA) and
-                  (self[i] != GUANINA) and
-                  (self[i] != CITOSINA) and
-                  (self[i] != BLANCO)):
+                    h.append(" " + fp % (pos) + "d" + r)
+            elif (cambio == MISSING):
                 missing.append(pos)
-                ultimo_cambio = MISSING
-            else:
-                ultimo_cambio = -1
-
-            # incrementar el contador
-            i = i + 1
+            ultimo_cambio = cambio
 
         # añadir los valores missing en el caso de que no sea vacío
         if (len(missing) > 0):
-            h = h + "  MISSING: " + listtoranges(missing)
+            h.append("  MISSING: " + listtoranges(missing))
         # si el haplotipo es vacío coincide con el CRS
-        if (h == ""):
-            h = ref.id
+        if (not h):
+            return ref.id
         # retornamos el haplotipo sin espacios antes y después
-        return h.strip()
+        return "".join(h).strip()
 
     def haplotype_forensic(self, ref):
         """
@@ -424,163 +614,91 @@ class Adn:
         Retorna:
           Una cadena con la representación del haplotipo.
         """
-        # posición de la secuencia
-        i = 0
+        # sólo se tienen en cuenta las columnas en las que difieren las dos
+        # secuencias (se presupone que tienen el mismo tamaño y que la
+        # referencia sólo contiene bases y huecos)
+        cols = self.diff_columns(ref)
+        return self.render_forensic(ref, cols, self.classify(ref, cols))
+
+    def render_forensic(self, ref, cols, cambios):
+        """
+        Construir el haplotipo en nomenclatura forense a partir de las
+        columnas distintas de la referencia y sus cambios.
+        Parámetros:
+            ref: secuencia de referencia.
+            cols: columnas ordenadas en las que la secuencia difiere.
+            cambios: tipo de cambio de cada columna.
+        Retorna:
+          Una cadena con la representación del haplotipo.
+        """
         # contador para las inserciones múltiples
         ins_counter = 0
         # lista para guardar los valores missing
         missing = []
-        # haplotipo
-        h = ""
-        # recorremos los elementos de las dos secuencias
-        # se presupone que tienen el mismo tamaño
-        while (i < len(self)):
+        # última columna distinta visitada
+        anterior = -2
+        # fragmentos del haplotipo, que se unen al final
+        h = []
+        for i, cambio in zip(cols, cambios):
+            if (i != anterior + 1):
+                ins_counter = 0
+            anterior = i
+            b = self[i]
             # posición actual de referencia
             pos = ref.posref[i]
-            # TRANSICIONES
-            if (
-                ((ref[i] == CITOSINA) and (self[i] == TIMINA)) or
-                ((ref[i] == TIMINA) and (self[i] == CITOSINA)) or
-                ((ref[i] == ADENINA) and (self[i] == GUANINA)) or
-                ((ref[i] == GUANINA) and (self[i] == ADENINA)) or
-                # TRANSVERSIONES
-                ((ref[i] == ADENINA) and (self[i] == TIMINA)) or
-                ((ref[i] == TIMINA) and (self[i] == ADENINA)) or
-                ((ref[i] == ADENINA) and (self[i] == CITOSINA)) or
-                ((ref[i] == CITOSINA) and (self[i] == ADENINA)) or
-                ((ref[i] == GUANINA) and (self[i] == TIMINA)) or
-                ((ref[i] == TIMINA) and (self[i] == GUANINA)) or
-                ((ref[i] == GUANINA) and (self[i] == CITOSINA)) or
-                ((ref[i] == CITOSINA) and (self[i] == GUANINA)) or
-                # HETEROPLASMIAS
-                (self[i] == ADEoGUA) or
-                (self[i] == ADEoGUA) or
-                (self[i] == CIToTIM) or
-                (self[i] == GUAoCIT) or
-                (self[i] == ADEoTIM) or
-                (self[i] == GUAoTIM) or
-                (self[i] == ADEoCIT) or
-                (self[i] == CIToGUAoTIM) or
-                (self[i] == ADEoGUAoTIM) or
-                (self[i] == ADEoCIToTIM) or
-                (self[i] == ADEoCIToGUA) or
-                (self[i] == ANYBASE)
-            ):
-                h = h + (" %d%s" % (pos, self[i]))
-                ins_counter = 0
-            # INSERCIONES
-            elif (
-                ((ref[i] == BLANCO) and (self[i] == TIMINA)) or
-                ((ref[i] == BLANCO) and (self[i] == ADENINA)) or
-                ((ref[i] == BLANCO) and (self[i] == GUANINA)) or
-                ((ref[i] == BLANCO) and (self[i] == CITOSINA))
-            ):
+            # en nomenclatura forense las transiciones, transversiones y
+            # heteroplasmias se representan igual
+            if (cambio == INSERTION):
                 ins_counter += 1
-                h = h + (" %d.%d%s" % (pos, ins_counter, self[i]))
-            # DELECIONES
-            elif (
-                ((ref[i] == TIMINA) and (self[i] == BLANCO)) or
-                ((ref[i] == ADENINA) and (self[i] == BLANCO)) or
-                ((ref[i] == GUANINA) and (self[i] == BLANCO)) or
-                ((ref[i] == CITOSINA) and (self[i] == BLANCO))
-            ):
-                h = h + (" %dd" % (pos))
-                ins_counter = 0
-            # MISSING
-            elif (
-                (self[i] != TIMINA) and
-                (self[i] != ADENINA) and
-                (self[i] != GUANINA) and
-                (self[i] != CITOSINA) and
-                (self[i] != BLANCO)
-            ):
+                h.append(" %d.%d%s" % (pos, ins_counter, b))
+                continue
+            elif (cambio == DELETION):
+                h.append(" %dd" % (pos))
+            elif (cambio == MISSING):
                 missing.append(pos)
-                ins_counter = 0
-            else:
-                ins_counter = 0
-
-            # incrementar el contador
-            i = i + 1
+            elif (cambio != IDENTITY):
+                h.append(" %d%s" % (pos, b))
+            ins_counter = 0
 
         # añadir los valores missing en el caso de que no sea vacío
         if (len(missing) > 0):
-            h = h + "  MISSING: " + listtoranges(missing)
+            h.append("  MISSING: " + listtoranges(missing))
         # si el haplotipo es vacío coincide con el CRS
-        if (h == ""):
-            h = ref.id
+        if (not h):
+            return ref.id
         # retornamos el haplotipo sin espacios antes y después
-        return h.strip()
+        return "".join(h).strip()
 
-    def align_sequence_population(self, begin_pos, nom_fich):
+    def align(self, begin_pos, insertions):
         """
-        Función que alinea una secuencia. El procedimiento es buscar en el
-        fichero de entrada todas las inserciones que existan e ir añadiendo
-        huecos a la secuencia de entrada, teniendo en cuenta que hay que
-        recalcular las posiciones en base a la posición que se pasa.
-        Se utiliza la nomenclatura de genética de poblaciones.
+        Función que alinea una secuencia añadiendo, tras cada posición, los
+        huecos necesarios para albergar la inserción más larga encontrada en
+        esa posición. La secuencia alineada se construye copiando de una vez
+        los tramos entre inserciones.
         Parámetros:
           begin_pos: posición de comienzo.
-          nom_fich: nombre del fichero de entrada.
+          insertions: diccionario posición -> longitud máxima de inserción.
         """
-        # en primer lugar calculamos las posiciones
+        # posiciones sobre la secuencia sin alinear
         self.build_positions(begin_pos)
-        # apertura del fichero
-        f = open(nom_fich)
-        # recorrer el fichero
-        for linea in f.readlines():
-            # recorremos cada elemento de la línea
-            for e in linea.strip().split():
-                # buscamos inserciones
-                m = re.compile(r"^(\d+)i([ATGC]+)$").match(e)
-                if (m):
-                    # se suma uno porque se supone que el hueco está en el
-                    # siguiente nucleótido
-                    pos = self.posref.index(int(m.group(1))) + 1
-                    # insertamos tantos huecos como número de bases hayan
-                    # especificado en la inserción
-                    for i in range(len(m.group(2))):
-                        # sólo insertamos el hueco si ahí ya no había otro
-                        if (self.sec[pos] != BLANCO):
-                            self.sec.insert(pos, BLANCO)
-                        pos += 1
-                    # hay que recalcular las posiciones
-                    self.build_positions(begin_pos)
-        # cerramos el fichero
-        f.close()
-
-    def align_sequence_forensic(self, begin_pos, nom_fich):
-        """
-        Función que alinea una secuencia. El procedimiento es buscar en el
-        fichero de entrada todas las inserciones que existan e ir añadiendo
-        huecos a la secuencia de entrada, teniendo en cuenta que hay que
-        recalcular las posiciones en base a la posición que se pasa.
-        Se utiliza la nomenclatura forense.
-        Parámetros:
-          begin_pos: posición de comienzo.
-          nom_fich: nombre del fichero de entrada.
-        """
-        # en primer lugar calculamos las posiciones
+        n = len(self.posidx)
+        sec = bytearray()
+        ini = 0
+        for pos in sorted(insertions):
+            k = pos - begin_pos
+            # las posiciones fuera de la referencia no se alinean
+            if (k < 0 or k >= n):
+                continue
+            # fin de la posición, incluyendo los huecos que ya tuviera
+            fin = self.posidx[k + 1] if k + 1 < n else len(self.sec)
+            existentes = fin - self.posidx[k] - 1
+            sec += self.sec[ini:fin]
+            sec += BLANCO_B * max(0, insertions[pos] - existentes)
+            ini = fin
+        sec += self.sec[ini:]
+        self.sec = sec
+        # calculamos las posiciones sobre la secuencia alineada
         self.build_positions(begin_pos)
-        # apertura del fichero
-        f = open(nom_fich)
-        # recorrer el fichero
-        for linea in f.readlines():
-            # recorremos cada elemento de la línea
-            for e in linea.strip().split():
-                # buscamos inserciones
-                m = re.compile(r"^(\d+)\.(\d+)([ATGC])$").match(e)
-                if (m):
-                    # si el desplazamiento es mayor que 0 significa que estamos
-                    # una inserción múltiple, en otro caso es la primera
-                    # inserción lo que conlleva sumar uno
-                    pos = self.posref.index(int(m.group(1))) + int(m.group(2))
-                    # sólo insertamos el hueco si ahí ya no había otro
-                    if (self.sec[pos] != BLANCO):
-                        self.sec.insert(pos, BLANCO)
-                    # hay que recalcular las posiciones
-                    self.build_positions(begin_pos)
-        # cerramos el fichero
-        f.close()
 
     def get_haplotype(self, nomenclature, ref, hvri):
         if nomenclature == "POP":
@@ -588,12 +706,718 @@ class Adn:
         else:
             return self.haplotype_forensic(ref)
 
+    def render_haplotype(self, nomenclature, ref, cols, cambios, hvri):
+        if nomenclature == "POP":
+            return self.render_population(ref, cols, cambios, hvri)
+        else:
+            return self.render_forensic(ref, cols, cambios)
+
+    def render_compact(self, ref):
+        """
+        Obtener los tramos en los que la secuencia alineada difiere de la de
+        referencia, con el formato "columna:bases" y separados por espacios.
+        Parámetros:
+          ref: secuencia de referencia alineada.
+        """
+        # agrupar las columnas distintas consecutivas en tramos [ini, fin)
+        tramos = []
+        for col in self.diff_columns(ref):
+            if (tramos and tramos[-1][1] == col):
+                tramos[-1][1] = col + 1
+            else:
+                tramos.append([col, col + 1])
+        return " ".join(
+            "%d:%s" % (ini, self.sec[ini:fin].decode("ascii"))
+            for ini, fin in tramos
+        )
+
 
-def sec2hap(nom_fichero_entrada, nom_fichero_salida, nomenclature, hvri):
+class ReferenceCache:
     """
-    Función que lee secuencias de un fichero de entrada y construye
-    los haplotipos asociados en base a una referencia, y además los
-    escribe en un fichero de salida.
+    Clase que guarda en un directorio las referencias alineadas (secuencia
+    con huecos e índices de posiciones), para que los trabajos con la misma
+    referencia y las mismas inserciones no tengan que volver a alinearla.
+    Cada referencia es un fichero cuyo nombre es la clave; al superar el
+    tamaño máximo se borran los menos usados recientemente. Los temporales
+    que ha dejado una escritura interrumpida se borran al hacer sitio.
+    """
+
+    def __init__(self, directory, max_size=REFCACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(ref, posbase, insertions):
+        """
+        Clave de una alineación: resumen de la referencia sin alinear, de la
+        posición base y de los huecos necesarios tras cada posición (que ya
+        no dependen de la nomenclatura).
+        """
+        h = hashlib.blake2b(bytes(ref.sec), digest_size=20)
+        h.update(b"%d|" % (posbase))
+        for pos in sorted(insertions):
+            h.update(b"%d:%d," % (pos, insertions[pos]))
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".ref")
+
+    def align(self, ref, posbase, insertions):
+        """
+        Alinear la referencia con la caché: si la alineación ya está guardada
+        se carga, y si no se calcula y se guarda.
+        Retorna:
+          cierto si la alineación estaba en la caché.
+        """
+        key = self.key(ref, posbase, insertions)
+        # un fallo de la caché no impide la conversión
+        try:
+            if (self.load(key, ref, posbase)):
+                return True
+        except OSError:
+            pass
+        ref.align(posbase, insertions)
+        try:
+            self.store(key, ref)
+        except OSError:
+            pass
+        return False
+
+    def load(self, key, ref, posbase):
+        try:
+            with open(self.path(key), "rb") as f:
+                datos = f.read()
+        except FileNotFoundError:
+            return False
+        ini = REFCACHE_HEADER.size
+        marca, n, m = REFCACHE_HEADER.unpack_from(datos.ljust(ini, b"\0"))
+        posref, posidx = array("i"), array("i")
+        tam = posref.itemsize
+        if (marca != REFCACHE_MAGIC or
+                len(datos) != ini + n + (n + m) * tam):
+            # fichero incompleto ó de otro formato: se descarta
+            os.remove(self.path(key))
+            return False
+        posref.frombytes(datos[ini + n:ini + n + n * tam])
+        posidx.frombytes(datos[ini + n + n * tam:])
+        ref.sec = bytearray(datos[ini:ini + n])
+        ref.posbase = posbase
+        ref.posref = posref
+        ref.posidx = posidx
+        # la fecha de modificación marca el último uso
+        os.utime(self.path(key))
+        return True
+
+    def store(self, key, ref):
+        # se escribe en un temporal y se renombra, para que otro proceso
+        # nunca lea un fichero a medias
+        f = NamedTemporaryFile(
+            dir=self.directory, prefix=REFCACHE_TMP_PREFIX,
+            suffix=REFCACHE_TMP_SUFFIX, delete=False
+        )
+        try:
+            with f:
+                f.write(REFCACHE_HEADER.pack(
+                    REFCACHE_MAGIC, len(ref.sec), len(ref.posidx)
+                ))
+                f.write(ref.sec)
+                f.write(ref.posref.tobytes())
+                f.write(ref.posidx.tobytes())
+            os.replace(f.name, self.path(key))
+        except BaseException:
+            os.remove(f.name)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Borrar los temporales abandonados y las referencias menos usadas
+        hasta caber en el tamaño. Los temporales recientes pueden ser de
+        otro proceso que aún está escribiendo, y sólo cuentan en el tamaño.
+        """
+        ficheros = []
+        total = 0
+        limite = time.time() - REFCACHE_TMP_AGE
+        for entrada in os.scandir(self.directory):
+            temporal = entrada.name.startswith(REFCACHE_TMP_PREFIX) and \
+                entrada.name.endswith(REFCACHE_TMP_SUFFIX)
+            if (not temporal and not entrada.name.endswith(".ref")):
+                continue
+            try:
+                st = entrada.stat()
+                if (temporal and st.st_mtime < limite):
+                    os.remove(entrada.path)
+                    continue
+            except FileNotFoundError:
+                continue
+            total += st.st_size
+            if (not temporal):
+                ficheros.append((st.st_mtime, st.st_size, entrada.path))
+        for _, tam, path in sorted(ficheros):
+            if (total <= self.max_size):
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= tam
+
+
+class PhaseStats:
+    """
+    Clase con las medidas de una fase de la conversión.
+    """
+
+    __slots__ = ("wall", "cpu", "records", "bytes")
+
+    def __init__(self):
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.records = 0
+        self.bytes = 0
+
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class RunStats:
+    """
+    Clase que mide, por fases, una conversión: lectura (read), alineamiento
+    y posiciones de la referencia (align), conversión de los registros
+    (convert) y escritura de la salida (write).
+    Las fases se pueden anidar y cada una se queda sólo con su tiempo propio:
+    al entrar en una fase se detiene la que la contiene. El tiempo de CPU es
+    el del hilo que convierte (no incluye los procesos de conversión).
+    Con trace_memory se mide además con tracemalloc el pico de memoria de
+    toda la conversión. tracemalloc mide todo el proceso: no se deben medir
+    a la vez dos conversiones.
+    """
+
+    PHASES = ("read", "align", "convert", "write")
+
+    def __init__(self, trace_memory=False):
+        self.phases = {nombre: PhaseStats() for nombre in self.PHASES}
+        self.trace_memory = trace_memory
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.peak_memory = None
+        self._pila = []
+        self._tracing = False
+
+    def _marca(self):
+        return time.perf_counter(), time.thread_time()
+
+    def _cargar(self):
+        """Cargar a la fase en curso lo transcurrido desde la última marca."""
+        wall, cpu = self._marca()
+        if (self._pila):
+            fase = self.phases[self._pila[-1]]
+            fase.wall += wall - self._ultima[0]
+            fase.cpu += cpu - self._ultima[1]
+        self._ultima = (wall, cpu)
+
+    def start(self):
+        if (self.trace_memory and not tracemalloc.is_tracing()):
+            tracemalloc.start()
+            self._tracing = True
+        self._inicio = self._ultima = self._marca()
+
+    def stop(self):
+        self._cargar()
+        wall, cpu = self._ultima
+        self.wall = wall - self._inicio[0]
+        self.cpu = cpu - self._inicio[1]
+        if (self._tracing):
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self._tracing = False
+
+    @contextmanager
+    def phase(self, nombre):
+        self._cargar()
+        self._pila.append(nombre)
+        try:
+            yield self.phases[nombre]
+        finally:
+            self._cargar()
+            self._pila.pop()
+
+    def iterate(self, nombre, registros):
+        """
+        Generador que recorre un iterable dentro de una fase, contando sus
+        elementos como registros de la fase.
+        """
+        fase = self.phases[nombre]
+        registros = iter(registros)
+        while (True):
+            with self.phase(nombre):
+                try:
+                    registro = next(registros)
+                except StopIteration:
+                    return
+                fase.records += 1
+            yield registro
+
+    def as_dict(self):
+        return {
+            "wall": self.wall,
+            "cpu": self.cpu,
+            "peak_memory": self.peak_memory,
+            "phases": {k: f.as_dict() for k, f in self.phases.items()},
+        }
+
+    def __str__(self):
+        return ", ".join(
+            "%s %.3fs" % (nombre, fase.wall)
+            for nombre, fase in self.phases.items()
+        ) + " (total %.3fs, cpu %.3fs)" % (self.wall, self.cpu)
+
+
+def phase(stats, nombre):
+    """Fase de stats, ó un contexto vacío si no se mide."""
+    return nullcontext() if stats is None else stats.phase(nombre)
+
+
+def iterate(stats, nombre, registros):
+    """Recorrido de registros dentro de una fase de stats (si se mide)."""
+    return registros if stats is None else stats.iterate(nombre, registros)
+
+
+class RunSummary:
+    """
+    Clase con el resumen de una conversión: registros convertidos y cuántos
+    de ellos se han resuelto con la memoria de registros repetidos, y las
+    medidas por fases (RunStats) si se han pedido.
+    """
+
+    __slots__ = ("records", "hits", "stats")
+
+    def __init__(self):
+        self.records = 0
+        self.hits = 0
+        self.stats = None
+
+    @property
+    def hit_rate(self):
+        return self.hits / self.records if self.records else 0.0
+
+    def __str__(self):
+        return "%d records, %d duplicates (%.1f%%)" % (
+            self.records, self.hits, 100 * self.hit_rate
+        )
+
+
+def sequence_key(sec):
+    """Resumen de los bytes de una secuencia, para reconocer repetidas."""
+    return hashlib.blake2b(sec, digest_size=16).digest()
+
+
+class Conversor:
+    """
+    Clase que convierte registros de entrada ya leídos (número de línea,
+    identificación y secuencia ó mutaciones) en registros de salida sobre una
+    referencia. Es lo único que se envía a los procesos de conversión.
+    """
+
+    def __init__(self, ref, nomenclature, operation, hvri=False,
+                 compact=False, summary=None):
+        """
+        Constructor de la clase.
+        Parámetros:
+            ref: secuencia de referencia, con sus posiciones construidas.
+            nomenclature: tipo de nomenclatura (poblaciones ó forense).
+            operation: S2H (secuencias a haplotipos) ó H2S (al revés).
+            hvri: indica si los haplotipos se muestran con 3 dígitos.
+            compact: indica si las secuencias se escriben como tramos
+                distintos de la referencia (sólo H2S).
+            summary: RunSummary donde se cuentan los registros convertidos.
+        """
+        self.ref = ref
+        self.nomenclature = nomenclature
+        self.operation = operation
+        self.hvri = hvri
+        self.compact = compact
+        self.summary = RunSummary() if summary is None else summary
+        # registros ya convertidos: clave del contenido -> texto de salida
+        self.memo = OrderedDict()
+
+    def convert(self, registro):
+        """
+        Convertir un registro de entrada en el texto de su registro de
+        salida. Los errores indican la línea de entrada del registro.
+        Los registros con el mismo contenido que uno reciente reutilizan su
+        haplotipo ó secuencia y sólo cambian su identificación.
+        """
+        num_linea, id, datos = registro
+        clave = self.memo_key(datos)
+        cuerpo = self.memo.get(clave)
+        if (cuerpo is None):
+            try:
+                cuerpo = self.render(id, datos)
+            except HaploException as err:
+                msg = f"Data error on input file [Line: {num_linea}]"
+                raise HaploException(msg + "\n" + err.args[0])
+            self.memo[clave] = cuerpo
+            if (len(self.memo) > MEMO_SIZE):
+                self.memo.popitem(last=False)
+        else:
+            self.memo.move_to_end(clave)
+            self.summary.hits += 1
+        self.summary.records += 1
+        return ">%s\n%s\n" % (id, cuerpo)
+
+    def memo_key(self, datos):
+        """
+        Clave del contenido de un registro: un resumen de los bytes de la
+        secuencia (S2H) ó sus mutaciones en el orden en que se escribieron
+        (H2S), que es el orden en que se aplican sobre la referencia.
+        """
+        if (self.operation == "S2H"):
+            return sequence_key(datos)
+        return tuple(datos)
+
+    def render(self, id, datos):
+        """
+        Obtener el haplotipo (S2H) ó la secuencia (H2S) de un registro.
+        """
+        if (self.operation == "S2H"):
+            a = Adn(id, datos)
+            return a.get_haplotype(self.nomenclature, self.ref, self.hvri)
+        elif (self.nomenclature == "POP"):
+            a = Adn.from_mutations_population(id, self.ref, datos)
+        else:
+            a = Adn.from_mutations_forensic(id, self.ref, datos)
+        if (self.compact):
+            return a.render_compact(self.ref)
+        return a.getseq_asstring()
+
+    def convert_chunk(self, registros):
+        return [self.convert(r) for r in registros]
+
+
+# conversor de cada proceso de conversión
+_conversor = None
+
+
+def _init_worker(conversor):
+    global _conversor
+    _conversor = conversor
+
+
+def _convert_chunk(registros):
+    # los aciertos de la memoria de cada proceso se suman en el principal
+    hits = _conversor.summary.hits
+    salidas = _conversor.convert_chunk(registros)
+    return salidas, _conversor.summary.hits - hits
+
+
+def convert_records(conversor, registros, workers=1, progress=None,
+                    chunk_size=CHUNK_SIZE):
+    """
+    Generador que convierte los registros de entrada y devuelve sus registros
+    de salida en el mismo orden. Con más de un proceso, la referencia viaja
+    una sola vez a cada proceso y los registros se reparten por bloques; sólo
+    se mantienen en vuelo unos pocos bloques por proceso.
+    Parámetros:
+      conversor: Conversor con la referencia y las opciones.
+      registros: iterable de registros de entrada.
+      workers: número de procesos de conversión.
+      progress: función a la que se pasa el número de registros convertidos.
+      chunk_size: número de registros de cada bloque.
+    """
+    if (workers <= 1):
+        convertidos = (conversor.convert(r) for r in registros)
+    else:
+        convertidos = convert_records_parallel(
+            conversor, registros, workers, chunk_size
+        )
+    if (progress is None):
+        yield from convertidos
+        return
+    for n, salida in enumerate(convertidos, 1):
+        progress(n)
+        yield salida
+
+
+def convert_records_parallel(conversor, registros, workers, chunk_size):
+    """
+    Generador que reparte la conversión de los registros entre varios
+    procesos y devuelve sus registros de salida en orden.
+    """
+    pendientes = deque()
+    with Pool(workers, _init_worker, (conversor,)) as pool:
+        while (True):
+            bloque = list(islice(registros, chunk_size))
+            if (bloque):
+                pendientes.append(pool.apply_async(_convert_chunk, (bloque,)))
+            # devolvemos, en orden, los bloques que sobrepasan el máximo en
+            # vuelo (ó todos los que queden al acabar la entrada)
+            while (pendientes and
+                   (not bloque or len(pendientes) >= 2 * workers)):
+                salidas, hits = pendientes.popleft().get()
+                conversor.summary.records += len(salidas)
+                conversor.summary.hits += hits
+                yield from salidas
+            if (not bloque):
+                break
+
+
+# símbolos válidos en la secuencia de referencia y en el resto de secuencias
+SIMBOLOS_REF = BASES + BLANCO
+SIMBOLOS_SEC = BASES + HETEROPLASMIAS + BLANCO
+
+
+def valid_sequence(sec, simbolos):
+    """
+    Función que comprueba que una línea (ya sin espacios en los extremos)
+    sólo tiene los símbolos indicados, sin distinguir mayúsculas.
+    La comprobación borra con translate los símbolos válidos y mira si
+    queda algo, sin recorrer la línea con una expresión regular.
+    Parámetros:
+      sec: línea con la secuencia (str ó bytes).
+      simbolos: cadena con los símbolos válidos (en mayúsculas).
+    Retorna:
+      la secuencia en mayúsculas y en bytes, ó None si no es válida.
+    """
+    if (isinstance(sec, str)):
+        if (not sec.isascii()):
+            return None
+        sec = sec.encode("ascii")
+    borrar = simbolos.encode("ascii")
+    if (sec.translate(None, borrar)):
+        # sólo se copia en mayúsculas si hace falta
+        sec = sec.upper()
+        if (sec.translate(None, borrar)):
+            return None
+    return sec or None
+
+
+class MappedSequences:
+    """
+    Clase que proyecta en memoria (mmap) un fichero de secuencias sin
+    comprimir y lo recorre por líneas buscando los saltos de línea en el
+    propio fichero. Cada secuencia se copia una única vez desde la
+    proyección, y se valida con valid_sequence.
+    El fichero se lee en orden, así que las páginas ya leídas se liberan cada
+    MAPPED_RELEASE bytes: la memoria no crece con el tamaño del fichero.
+    """
+
+    def __init__(self, nom_fichero):
+        with open(nom_fichero, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.pos = 0
+        # inicio de las páginas leídas que aún no se han liberado
+        self.liberado = 0
+        if (hasattr(mmap, "MADV_SEQUENTIAL")):
+            self.mm.madvise(mmap.MADV_SEQUENTIAL)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.mm.close()
+
+    def next_line(self):
+        """Siguiente línea, sin el salto de línea (None al acabar)."""
+        if (self.pos >= len(self.mm)):
+            return None
+        fin = self.mm.find(b"\n", self.pos)
+        if (fin == -1):
+            fin = len(self.mm)
+        linea = self.mm[self.pos:fin]
+        self.pos = fin + 1
+        if (self.pos - self.liberado >= MAPPED_RELEASE):
+            self.release()
+        return linea
+
+    def release(self):
+        """Liberar las páginas completas anteriores a la posición actual."""
+        if (not hasattr(mmap, "MADV_DONTNEED")):
+            return
+        fin = min(self.pos, len(self.mm)) // mmap.PAGESIZE * mmap.PAGESIZE
+        if (fin > self.liberado):
+            self.mm.madvise(
+                mmap.MADV_DONTNEED, self.liberado, fin - self.liberado
+            )
+            self.liberado = fin
+
+
+class RecordReader:
+    """
+    Clase que lee un fichero por registros al estilo FASTA: una línea de
+    identificación (">") seguida de una ó varias líneas de datos, de modo
+    que las secuencias pueden venir partidas en líneas de cualquier longitud.
+    Las líneas vacías se saltan y se lleva la cuenta del número de línea.
+    Las líneas de un MappedSequences se devuelven en bytes.
+    """
+
+    def __init__(self, fichero_entrada):
+        if (isinstance(fichero_entrada, MappedSequences)):
+            self.siguiente = fichero_entrada.next_line
+        else:
+            self.siguiente = fichero_entrada.readline
+        self.num_linea = 0
+        # línea de identificación leída de más al acabar el registro anterior
+        self.pendiente = None
+
+    def readline(self):
+        """Siguiente línea sin espacios en los extremos (None al acabar)."""
+        linea = self.siguiente()
+        # al acabar, readline devuelve "" y next_line None (b"" es una línea
+        # vacía del fichero proyectado)
+        if (not linea and linea != b""):
+            return None
+        self.num_linea = self.num_linea + 1
+        return linea.strip()
+
+    def next_record(self):
+        """
+        Leer el siguiente registro.
+        Retorna:
+          una tupla (número de línea de la identificación, identificación,
+          lista de pares (número de línea, datos)), ó None al acabar.
+        """
+        if (self.pendiente is not None):
+            num_id, linea = self.pendiente
+            self.pendiente = None
+        else:
+            linea = ""
+            while (not linea):
+                linea = self.readline()
+                if (linea is None):
+                    return None
+            num_id = self.num_linea
+        if (isinstance(linea, bytes)):
+            linea = linea.decode("ascii", "replace")
+        # controlamos un posible error de sintaxis
+        id = linea[1:].lstrip()
+        if (linea[0] != ">" or not id):
+            raise HaploException(f"Syntax error on input file [Line: {num_id}]")
+        datos = []
+        while (True):
+            linea = self.readline()
+            if (linea is None):
+                break
+            if (linea[:1] in (">", b">")):
+                self.pendiente = (self.num_linea, linea)
+                break
+            if (linea):
+                datos.append((self.num_linea, linea))
+        return num_id, id, datos
+
+
+def record_reader(fichero_entrada):
+    if (isinstance(fichero_entrada, RecordReader)):
+        return fichero_entrada
+    return RecordReader(fichero_entrada)
+
+
+def join_sequence(num_id, datos, simbolos):
+    """
+    Función que une y valida las líneas de datos de una secuencia.
+    Parámetros:
+      num_id: número de línea de la identificación de la secuencia.
+      datos: lista de pares (número de línea, línea de la secuencia).
+      simbolos: cadena con los símbolos válidos.
+    Retorna:
+      el número de la primera línea de la secuencia y la secuencia en bytes.
+    """
+    if (not datos):
+        raise HaploException(
+            f"Syntax error on input file [Line: {num_id + 1}]"
+        )
+    partes = []
+    for num_linea, linea in datos:
+        sec = valid_sequence(linea, simbolos)
+        # controlamos un posible error de sintaxis
+        if (sec is None):
+            raise HaploException(
+                f"Syntax error on input file [Line: {num_linea}]"
+            )
+        partes.append(sec)
+    return datos[0][0], b"".join(partes)
+
+
+def read_start(lector, patron):
+    """
+    Función que lee la primera línea de un fichero, con la posición base.
+    """
+    l = lector.readline() or ""
+    if (isinstance(l, bytes)):
+        l = l.decode("ascii", "replace")
+    g = re.compile(patron).match(l)
+    if (not g):
+        raise HaploException("Base position is not defined on input file")
+    return int(g.group(1))
+
+
+def read_reference_sequence(fichero_entrada, stats=None):
+    """
+    Función que lee la cabecera de un fichero de secuencias: la posición base
+    y la secuencia de referencia, cuyas posiciones quedan construidas.
+    Parámetros:
+      fichero_entrada: fichero de secuencias abierto, MappedSequences ó
+      RecordReader (que hay que seguir usando para leer las secuencias).
+      stats: RunStats donde se mide la construcción de las posiciones.
+    Retorna:
+      la posición base y la secuencia de referencia.
+    """
+    lector = record_reader(fichero_entrada)
+    # en la primera fila se encuentra la posición base
+    posbase = read_start(lector, r"^START *: *(\d+) *$")
+    # a continuación viene la secuencia de referencia
+    registro = lector.next_record()
+    if (registro is None):
+        raise HaploException(
+            f"Syntax error on input file [Line: {lector.num_linea + 1}]"
+        )
+    num_id, id, datos = registro
+    _, sec = join_sequence(num_id, datos, SIMBOLOS_REF)
+    # construimos la secuencia de referencia
+    ref = Adn(id, sec)
+    # construimos las posiciones de referencia
+    with phase(stats, "align"):
+        ref.build_positions(posbase)
+    return posbase, ref
+
+
+def read_sequences(fichero_entrada, ref):
+    """
+    Generador que lee las secuencias de un fichero, una vez leída la
+    cabecera, comprobando que tienen la misma longitud que la referencia.
+    Cada secuencia puede ocupar varias líneas, y los registros pueden estar
+    separados por líneas vacías.
+    Parámetros:
+      fichero_entrada: RecordReader con el que se leyó la cabecera.
+      ref: secuencia de referencia.
+    Retorna:
+      tuplas (número de la primera línea de la secuencia, identificación,
+      secuencia en bytes).
+    """
+    lector = record_reader(fichero_entrada)
+    while (True):
+        registro = lector.next_record()
+        if (registro is None):
+            break
+        num_id, id, datos = registro
+        num_linea, sec = join_sequence(num_id, datos, SIMBOLOS_SEC)
+        # controlamos que la secuencia de entrada tenga el mismo número de
+        # bases que la secuencia de referencia
+        if (len(sec) != len(ref)):
+            raise HaploException(
+                "Sequence has not the same number of bases as the reference "
+                f"sequence [Line: {num_linea}]"
+            )
+        yield num_linea, id, sec
+
+
+def iter_haplotypes(stream, nomenclature, hvri=False, workers=1,
+                    progress=None, summary=None, stats=None):
+    """
+    Generador que lee secuencias de un fichero abierto y devuelve, uno a uno,
+    los registros de salida con los haplotipos asociados en base a una
+    referencia. Sólo se mantienen en memoria los registros en curso.
     La estructura del fichero de secuencias es la siguiente:
     START: x  (indica la posición en el que se empieza a contar la secuencia
     de referencia)
@@ -604,106 +1428,185 @@ def sec2hap(nom_fichero_entrada, nom_fichero_salida, nomenclature, hvri):
     >[IDENTIFICACIÓN DE LA SEGUNDA SECUENCIA]
     [SEGUNDA SECUENCIA]
     ...
+    Parámetros:
+    stream: fichero de datos de entrada (secuencias)
     nomenclature: tipo de nomenclatura (poblaciones ó forense)
+    hvri: indica si los haplotipos se muestran con 3 dígitos o normales
+    workers: número de procesos que convierten las secuencias
+    progress: función a la que se pasa el número de secuencias convertidas
+    summary: RunSummary donde se cuentan las secuencias y las repetidas
+    stats: RunStats donde se miden las fases de lectura y alineamiento
     """
-    # apertura de los ficheros
-    fichero_entrada = open(nom_fichero_entrada, "r")
-    fichero_salida = open(nom_fichero_salida, "w")
-    # en la primera fila se encuentra la posición base
-    l = fichero_entrada.readline().strip()
-    g = re.compile(r"^START *: *(\d+) *$").match(l)
-    if g:
-        posbase = int(g.group(1))
-    else:
-        raise HaploException(
-            "Base position is not defined on input file"
+    # leemos la posición base y la secuencia de referencia
+    lector = RecordReader(stream)
+    with phase(stats, "read"):
+        posbase, ref = read_reference_sequence(lector, stats)
+    # la salida empieza por la posición base y la secuencia de referencia
+    yield "START: %d\n" % (posbase)
+    yield "%s\n" % (ref.versinhuecos())
+    conversor = Conversor(ref, nomenclature, "S2H", hvri, summary=summary)
+    registros = iterate(stats, "read", read_sequences(lector, ref))
+    yield from convert_records(conversor, registros, workers, progress)
+
+
+@lru_cache(maxsize=None)
+def numpy_change_table():
+    """
+    Función que construye la tabla de cambios como una matriz de NumPy de
+    256 x 256 indexada por los bytes (base de referencia, base). Cada celda
+    contiene el índice del tipo de cambio en CODIGOS_CAMBIO.
+    """
+    tabla = np.zeros((256, 256), dtype=np.uint8)
+    for r in range(256):
+        for b in range(256):
+            cambio = tipo_cambio(chr(r), chr(b))
+            tabla[r, b] = CODIGOS_CAMBIO.index(cambio)
+    return tabla
+
+
+def iter_haplotypes_batch(stream, nomenclature, hvri=False, progress=None,
+                          batch_size=BATCH_SIZE, summary=None, stats=None):
+    """
+    Motor alternativo a iter_haplotypes que clasifica las secuencias por
+    lotes con NumPy. Cada lote se carga en una matriz de bytes (secuencias x
+    columnas) que se clasifica de una vez contra la referencia mediante la
+    tabla de cambios; después se construye el haplotipo de cada fila con las
+    mismas reglas de formato. Si NumPy no está disponible se utiliza
+    iter_haplotypes.
+    Parámetros:
+    stream: fichero de datos de entrada (secuencias)
+    nomenclature: tipo de nomenclatura (poblaciones ó forense)
+    hvri: indica si los haplotipos se muestran con 3 dígitos o normales
+    progress: función a la que se pasa el número de secuencias convertidas
+    batch_size: número de secuencias que se clasifican a la vez
+    summary: RunSummary donde se cuentan las secuencias y las repetidas
+    stats: RunStats donde se miden las fases de lectura y alineamiento
+    """
+    if np is None:
+        yield from iter_haplotypes(
+            stream, nomenclature, hvri, progress=progress, summary=summary,
+            stats=stats
         )
-    # inicializamos el número de línea
-    num_linea = 2
-    # en la primera línea está la identificación de la secuencia de referencia
-    m = re.compile(r"^ *> *(.+)$").match(fichero_entrada.readline().rstrip())
-    # controlamos un posible error de sintaxis
-    if (not m):
-        raise HaploException(f"Syntax error on input file [Line: {num_linea}]")
-    id = m.group(1)
-    # en la segunda línea está la secuencia de referencia en sí misma
-    num_linea = 3
-    m = re.compile(r"^ *([AGTC-]+) *$").match(
-        fichero_entrada.readline().strip().upper()
-    )
-    # controlamos un posible error de sintaxis
-    if (not m):
-        raise HaploException(f"Syntax error on input file [Line: {num_linea}]")
-    sec = m.group(1)
-    # construimos la secuencia de referencia
-    ref = Adn(id, sec)
-    # construimos las posiciones de referencia
-    ref.build_positions(posbase)
-    # escribimos la posición base en el fichero de salida
-    fichero_salida.write("START: %d\n" % (posbase))
-    # escribimos la secuencia de referencia en el fichero de salida
-    fichero_salida.write("%s\n" % (ref.versinhuecos()))
-    # procesamiento del resto del fichero
-    num_linea = 4
-    # recorremos el fichero de entrada
+        return
+    tabla = numpy_change_table()
+    # leemos la posición base y la secuencia de referencia
+    lector = RecordReader(stream)
+    with phase(stats, "read"):
+        posbase, ref = read_reference_sequence(lector, stats)
+    fila_ref = np.frombuffer(bytes(ref.sec), np.uint8)
+    yield "START: %d\n" % (posbase)
+    yield "%s\n" % (ref.versinhuecos())
+    registros = iterate(stats, "read", read_sequences(lector, ref))
+    if (summary is None):
+        summary = RunSummary()
+    # haplotipos de las secuencias distintas más recientes
+    memo = OrderedDict()
     while (True):
-        # los datos vienen emparejados
-        # la primera línea es la identificación de la secuencia
-        linea = fichero_entrada.readline().strip()
-        if (linea == ""):
+        lote = list(islice(registros, batch_size))
+        if (not lote):
             break
-        m = re.compile(r"^ *> *(.+)$").match(linea)
-        # controlamos un posible error de sintaxis
-        if (not m):
-            raise HaploException(
-                f"Syntax error on input file [Line: {num_linea}]"
-            )
-        # si todo ha ido bien tenemos el identificador en el primer grupo
-        id = m.group(1)
-        # la segunda línea es la secuencia de adn
-        num_linea = num_linea + 1
-        m = re.compile(r"^ *([AGTCRYSWKMBDHVN-]+) *$").match(
-            fichero_entrada.readline().strip().upper()
+        # sólo se clasifica la primera aparición de cada secuencia nueva
+        claves = [sequence_key(sec) for _, _, sec in lote]
+        nuevas = {}
+        for k, clave in enumerate(claves):
+            if (clave not in memo) and (clave not in nuevas):
+                nuevas[clave] = k
+        hechos = {}
+        if (nuevas):
+            filas_lote = list(nuevas.values())
+            # matriz de bytes de las filas y tipo de cambio de cada celda
+            matriz = np.frombuffer(
+                b"".join(lote[k][2] for k in filas_lote),
+                np.uint8
+            ).reshape(len(filas_lote), len(ref))
+            codigos = tabla[fila_ref, matriz]
+            # celdas distintas de la referencia, ordenadas por fila y columna
+            filas, cols = np.nonzero(codigos)
+            limites = np.searchsorted(filas, np.arange(len(filas_lote) + 1))
+            for i, k in enumerate(filas_lote):
+                num_linea, id, sec = lote[k]
+                ini, fin = limites[i], limites[i + 1]
+                c = cols[ini:fin].tolist()
+                cambios = [CODIGOS_CAMBIO[x] for x in codigos[i, c].tolist()]
+                a = Adn(id, sec)
+                try:
+                    hechos[claves[k]] = a.render_haplotype(
+                        nomenclature, ref, c, cambios, hvri
+                    )
+                except HaploException as err:
+                    msg = f"Data error on input file [Line: {num_linea}]"
+                    raise HaploException(msg + "\n" + err.args[0])
+        for k, (num_linea, id, sec) in enumerate(lote):
+            h = hechos.get(claves[k])
+            if (h is None):
+                h = memo[claves[k]]
+                memo.move_to_end(claves[k])
+            yield ">%s\n%s\n" % (id, h)
+        memo.update(hechos)
+        while (len(memo) > MEMO_SIZE):
+            memo.popitem(last=False)
+        summary.records += len(lote)
+        summary.hits += len(lote) - len(hechos)
+        if (progress is not None):
+            progress(summary.records)
+
+
+def read_reference_haplotypes(fichero_entrada):
+    """
+    Función que lee la cabecera de un fichero de haplotipos: la posición base
+    y la secuencia de referencia, todavía sin alinear.
+    Parámetros:
+      fichero_entrada: fichero de haplotipos abierto ó RecordReader (que hay
+      que seguir usando para leer los haplotipos).
+    Retorna:
+      la posición base y la secuencia de referencia.
+    """
+    lector = record_reader(fichero_entrada)
+    # en la primera fila se encuentra la posición base
+    posbase = read_start(lector, r"^START: *(\d+)")
+    # a continuación viene la secuencia de referencia
+    registro = lector.next_record()
+    if (registro is None):
+        raise HaploException(
+            f"Syntax error on input file [Line: {lector.num_linea + 1}]"
         )
-        # controlamos un posible error de sintaxis
-        if (not m):
-            raise HaploException(
-                f"Syntax error on input file [Line: {num_linea}]"
-            )
-        # si todo ha ido bien tenemos la secuencia en el primer grupo
-        sec = m.group(1)
-        # controlamos que la secuencia de entrada tenga el mismo número de
-        # bases que la secuencia de referencia
-        if (len(sec) != len(ref)):
-            raise HaploException(
-                f"Sequence has not the same number of bases as the reference "
-                "sequence [Line: {num_linea}]"
-            )
-        # construimos una nueva secuencia
-        a = Adn(id, sec)
-        # escribimos la secuencia en el fichero de salida
-        try:
-            h = a.get_haplotype(nomenclature, ref, hvri)
-        except HaploException as err:
-            msg = f"Data error on input file [Line: {num_linea}]"
-            raise HaploException(msg + "\n" + err.args[0])
-        fichero_salida.write(">%s\n%s\n" % (a.id, h))
-        # incrementamos el número de línea
-        num_linea = num_linea + 1
-    # cerramos los ficheros
-    fichero_entrada.close()
-    fichero_salida.close()
+    num_id, id, datos = registro
+    _, sec = join_sequence(num_id, datos, BASES)
+    return posbase, Adn(id, sec)
 
 
-def hap2sec(nom_fichero_entrada, nom_fichero_salida, nomenclature):
+def read_haplotypes(fichero_entrada):
     """
-    Función que lee haplotipos de un fichero de entrada y construye
-    las secuencias asociadas en base a una referencia, y además las
-    escribe en un fichero de salida.
+    Generador que lee los haplotipos de un fichero, una vez leída la
+    cabecera. Un haplotipo puede ocupar varias líneas (ó ninguna, si no
+    tiene mutaciones).
     Parámetros:
-    nom_fichero_entrada: nombre del fichero de datos de entrada (haplotipos)
-    nom_fichero_salida: nombre del fichero de datos de salida (secuencias)
+      fichero_entrada: RecordReader con el que se leyó la cabecera.
+    Retorna:
+      tuplas (número de la primera línea del haplotipo, identificación,
+      haplotipo).
+    """
+    lector = record_reader(fichero_entrada)
+    while (True):
+        registro = lector.next_record()
+        if (registro is None):
+            break
+        num_id, id, datos = registro
+        if (datos):
+            yield datos[0][0], id, " ".join(linea for _, linea in datos)
+        else:
+            yield num_id + 1, id, ""
+
 
+def iter_sequences(stream, nomenclature, workers=1, progress=None,
+                   compact=False, summary=None, refcache=None, stats=None):
+    """
+    Generador que lee haplotipos de un fichero abierto y devuelve, uno a uno,
+    los registros de salida con las secuencias asociadas en base a una
+    referencia. El fichero se lee una única vez: cada haplotipo se separa en
+    sus mutaciones, que sirven tanto para alinear la referencia como para
+    construir después las secuencias, y se guardan mientras tanto en un
+    fichero temporal que sólo pasa a disco si es grande.
     La estructura del fichero de haplotipos es la siguiente:
     START: x  (indica la posición en el que se empieza a contar la secuencia de
     referencia)
@@ -714,98 +1617,600 @@ def hap2sec(nom_fichero_entrada, nom_fichero_salida, nomenclature):
     >[IDENTIFICACIÓN DE LA SEGUNDA SECUENCIA]
     [HAPLOTIPO DE LA SEGUNDA SECUENCIA]
     ...
+    Parámetros:
+    stream: fichero de datos de entrada (haplotipos)
     nomenclature: tipo de nomenclatura (poblaciones ó forense)
+    workers: número de procesos que construyen las secuencias
+    progress: función a la que se pasa el número de secuencias construidas
+    compact: escribe cada secuencia como sus tramos distintos de la
+        referencia alineada (ver expand_compact)
+    summary: RunSummary donde se cuentan los haplotipos y los repetidos
+    refcache: ReferenceCache con las referencias ya alineadas
+    stats: RunStats donde se miden las fases de lectura y alineamiento
     """
-    # apertura de los ficheros
-    fichero_entrada = open(nom_fichero_entrada, "r")
-    fichero_salida = open(nom_fichero_salida, "w")
-    # en la primera fila se encuentra la posición base
-    l = fichero_entrada.readline().strip()
-    g = re.compile(r"^START: *(\d+)").match(l)
-    if (g):
-        posbase = int(g.group(1))
-    else:
-        raise HaploException("Base position is not defined on input file")
-    # inicializamos el número de línea
-    num_linea = 2
-    # en la segunda línea está la identificación de la secuencia de referencia
-    m = re.compile(r"^ *> *(.+)$").match(fichero_entrada.readline().rstrip())
-    # controlamos un posible error de sintaxis
-    if (not m):
-        raise HaploException(
-            f"Syntax error on input file [Line: {num_linea}]"
+    # leemos la posición base y la secuencia de referencia
+    lector = RecordReader(stream)
+    # separamos los haplotipos en mutaciones y recogemos sus inserciones
+    insertions = {}
+    mutaciones = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    with phase(stats, "read"):
+        posbase, ref = read_reference_haplotypes(lector)
+        haplotipos = iterate(stats, "read", read_haplotypes(lector))
+        for num_linea, id, hap in haplotipos:
+            try:
+                mutations = split_haplotype(hap, ref.id, nomenclature)
+            except HaploException as err:
+                msg = f"Data error on input file [Line: {num_linea}]"
+                raise HaploException(msg + "\n" + err.args[0])
+            add_insertions(insertions, mutations, nomenclature)
+            pickle.dump(
+                (num_linea, id, mutations), mutaciones, PICKLE_PROTOCOL
+            )
+    # alinear la secuencia de referencia
+    with phase(stats, "align"):
+        if (refcache is None):
+            ref.align(posbase, insertions)
+        else:
+            refcache.align(ref, posbase, insertions)
+    # la salida empieza por la posición base y la secuencia de referencia
+    if (compact):
+        yield COMPACT_HEADER
+    yield "START: %d\n" % (posbase)
+    yield "%s\n" % (ref)
+    mutaciones.seek(0)
+    with mutaciones:
+        conversor = Conversor(
+            ref, nomenclature, "H2S", compact=compact, summary=summary
+        )
+        yield from convert_records(
+            conversor, read_pickled(mutaciones), workers, progress
         )
-    id = m.group(1)
-    # en la tercera línea está la secuencia de referencia en sí misma
-    num_linea = 3
-    m = re.compile(r"^ *([AGTC]+) *$").match(
-        fichero_entrada.readline().strip().upper()
+
+
+def read_variants(stream, nomenclature, stats=None):
+    """
+    Función que lee un fichero de haplotipos y numera las variantes
+    observadas (las Mutation distintas, así que "3107d" y "3107del" son la
+    misma) y los haplotipos distintos.
+    Parámetros:
+      stream: fichero de datos de entrada (haplotipos)
+      nomenclature: tipo de nomenclatura (poblaciones ó forense)
+      stats: RunStats donde se mide la lectura
+    Retorna:
+      las identificaciones de las muestras, el índice del haplotipo de cada
+      una, el conjunto de índices de variantes de cada haplotipo distinto y
+      el número de variantes.
+    """
+    lector = RecordReader(stream)
+    ids = []
+    unicos = []
+    haplotipos = {}
+    variantes = {}
+    with phase(stats, "read"):
+        _, ref = read_reference_haplotypes(lector)
+        registros = iterate(stats, "read", read_haplotypes(lector))
+        for num_linea, id, hap in registros:
+            try:
+                mutations = split_haplotype(hap, ref.id, nomenclature)
+            except HaploException as err:
+                msg = f"Data error on input file [Line: {num_linea}]"
+                raise HaploException(msg + "\n" + err.args[0])
+            conjunto = frozenset(
+                variantes.setdefault(m, len(variantes)) for m in mutations
+            )
+            ids.append(id)
+            unicos.append(haplotipos.setdefault(conjunto, len(haplotipos)))
+    return ids, unicos, list(haplotipos), len(variantes)
+
+
+def encode_bitsets(haplotipos, n_variantes):
+    """
+    Función que codifica las variantes de cada haplotipo como un bitset.
+    Las variantes de un solo haplotipo no ocupan bit: suman siempre 1 a la
+    distancia de ese haplotipo con cualquier otro, así que se cuentan
+    aparte; tampoco las que tienen todos, que no suman nunca.
+    Parámetros:
+      haplotipos: conjunto de índices de variantes de cada haplotipo.
+      n_variantes: número de variantes.
+    Retorna:
+      los bitsets (matriz de uint64 haplotipos x palabras con NumPy, ó lista
+      de enteros) y el número de variantes propias de cada haplotipo.
+    """
+    frecuencia = [0] * n_variantes
+    for variantes in haplotipos:
+        for v in variantes:
+            frecuencia[v] += 1
+    bits = {}
+    for v, f in enumerate(frecuencia):
+        if (1 < f < len(haplotipos)):
+            bits[v] = len(bits)
+    propias = [sum(frecuencia[v] == 1 for v in h) for h in haplotipos]
+    if (np is None):
+        bitsets = [
+            sum(1 << bits[v] for v in variantes if v in bits)
+            for variantes in haplotipos
+        ]
+        return bitsets, propias
+    filas = []
+    cols = []
+    for i, variantes in enumerate(haplotipos):
+        for v in variantes:
+            if (v in bits):
+                filas.append(i)
+                cols.append(bits[v])
+    palabras = max(1, (len(bits) + 63) // 64)
+    bitsets = np.zeros((len(haplotipos), palabras), np.uint64)
+    cols = np.array(cols, np.uint64)
+    palabra = (cols >> np.uint64(6)).astype(np.intp)
+    np.bitwise_or.at(
+        bitsets, (np.array(filas, np.intp), palabra),
+        np.uint64(1) << (cols & np.uint64(63))
     )
-    # controlamos un posible error de sintaxis
-    if (not m):
-        raise HaploException(
-            f"Syntax error on input file [Line: {num_linea}]"
+    return bitsets, np.array(propias, np.int64)
+
+
+@lru_cache(maxsize=None)
+def numpy_popcount_table():
+    """Número de bits a 1 de cada byte, para NumPy sin bitwise_count."""
+    return np.array([bin(b).count("1") for b in range(256)], np.uint8)
+
+
+def popcount(bloque):
+    """Número de bits a 1 de cada fila (último eje) de un bloque uint64."""
+    if (hasattr(np, "bitwise_count")):
+        return np.bitwise_count(bloque).sum(axis=-1, dtype=np.int64)
+    tabla = numpy_popcount_table()
+    return tabla[bloque.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+def distance_rows(bitsets, propias, filas):
+    """
+    Función que calcula las distancias (número de variantes que sólo tiene
+    uno de los dos) de los haplotipos de filas con todos. Con NumPy se
+    compara el bloque de filas con bloques de columnas, de forma que el XOR
+    de los bitsets no ocupe más de DISTANCE_BLOCK_BYTES.
+    Retorna:
+      las filas de distancias, como matriz de NumPy ó listas de enteros.
+    """
+    n = len(propias)
+    if (np is None):
+        return [
+            [
+                bin(bitsets[i] ^ bitsets[j]).count("1") + propias[i] +
+                propias[j] if i != j else 0
+                for j in range(n)
+            ]
+            for i in filas
+        ]
+    bloque_filas = bitsets[filas]
+    ancho = max(1, DISTANCE_BLOCK_BYTES // (bloque_filas.nbytes or 1))
+    d = np.empty((len(filas), n), np.int64)
+    for j in range(0, n, ancho):
+        bloque = bitsets[j:j + ancho]
+        d[:, j:j + ancho] = popcount(
+            bloque_filas[:, None, :] ^ bloque[None, :, :]
         )
-    sec = m.group(1)
-    # construimos la secuencia de referencia
-    ref = Adn(id, sec)
-    # cerrar temporalmente el fichero de entrada
-    fichero_entrada.close()
-    # alinear la secuencia de referencia
-    if nomenclature == "POP":
-        ref.align_sequence_population(posbase, nom_fichero_entrada)
-        build_sequence = Adn.from_haplotype_population
+    d += propias[filas, None]
+    d += propias[None, :]
+    d[np.arange(len(filas)), filas] = 0
+    return d
+
+
+def distance_tile(bitsets, propias, unicos, ini, fin):
+    """
+    Función que calcula las filas ini..fin-1 de la matriz de distancias
+    entre muestras. Sólo se comparan los haplotipos distintos, y cada fila
+    se construye después con los índices de los haplotipos de las muestras.
+    """
+    if (np is None):
+        filas = sorted(set(unicos[ini:fin]))
+        d = dict(zip(filas, distance_rows(bitsets, propias, filas)))
+        return [[d[u][v] for v in unicos] for u in unicos[ini:fin]]
+    filas, inversa = np.unique(unicos[ini:fin], return_inverse=True)
+    return distance_rows(bitsets, propias, filas)[inversa][:, unicos]
+
+
+def iter_distances(stream, nomenclature, max_distance=None, progress=None,
+                   summary=None, stats=None):
+    """
+    Generador que lee haplotipos de un fichero abierto y devuelve, línea a
+    línea, la matriz de distancias entre las muestras: el número de
+    variantes que sólo tiene una de las dos. La matriz se calcula y se
+    escribe por bloques de DISTANCE_TILE filas, así que sólo se guardan en
+    memoria los bitsets de los haplotipos distintos y un bloque de
+    distancias.
+    Sin max_distance, la salida es la matriz completa separada por
+    tabuladores, con una fila de cabecera con las identificaciones; con
+    max_distance, es la lista de pares de muestras (cada par una vez) con
+    distancia menor ó igual.
+    Parámetros:
+    stream: fichero de datos de entrada (haplotipos)
+    nomenclature: tipo de nomenclatura (poblaciones ó forense)
+    max_distance: distancia máxima de los pares que se escriben
+    progress: función a la que se pasa el número de filas calculadas
+    summary: RunSummary donde se cuentan las muestras y las que repiten el
+        haplotipo de otra
+    stats: RunStats donde se miden las fases de lectura y cálculo
+    """
+    ids, unicos, haplotipos, n_variantes = read_variants(
+        stream, nomenclature, stats
+    )
+    with phase(stats, "convert"):
+        bitsets, propias = encode_bitsets(haplotipos, n_variantes)
+        if (np is not None):
+            unicos = np.array(unicos, np.intp)
+    if (max_distance is None):
+        yield "ID\t%s\n" % ("\t".join(ids))
     else:
-        ref.align_sequence_forensic(posbase, nom_fichero_entrada)
-        build_sequence = Adn.from_haplotype_forensic
-    # abrimos de nuevo el fichero de entrada e
-    # ignoramos las tres primeras líneas
-    fichero_entrada = open(nom_fichero_entrada, "r")
-    fichero_entrada.readline()
-    fichero_entrada.readline()
-    fichero_entrada.readline()
-    # escribimos la posición base en el fichero de salida
-    fichero_salida.write("START: %d\n" % (posbase))
-    # escribimos la secuencia de referencia en el fichero de salida
-    fichero_salida.write("%s\n" % (ref))
-    # procesamiento del resto del fichero
-    num_linea = 4
-    while (True):
-        # los datos vienen emparejados
-        # la primera línea es la identificación de la secuencia
-        linea = fichero_entrada.readline().strip()
-        if (linea == ""):
-            break
-        m = re.compile(r"^ *> *(.+)$").match(linea)
-        # controlamos un posible error de sintaxis
-        if (not m):
-            raise HaploException(
-                f"Syntax error on input file [Line: {num_linea}]"
+        yield "ID1\tID2\tDISTANCE\n"
+    n = len(ids)
+    for ini in range(0, n, DISTANCE_TILE):
+        fin = min(n, ini + DISTANCE_TILE)
+        d = distance_tile(bitsets, propias, unicos, ini, fin)
+        if (max_distance is None):
+            for i, fila in enumerate(d, ini):
+                if (np is not None):
+                    fila = fila.tolist()
+                yield "%s\t%s\n" % (ids[i], "\t".join(map(str, fila)))
+        elif (np is None):
+            for i, fila in enumerate(d, ini):
+                yield "".join(
+                    "%s\t%s\t%d\n" % (ids[i], ids[j], fila[j])
+                    for j in range(i + 1, n) if fila[j] <= max_distance
+                )
+        else:
+            # pares de la parte superior de la matriz
+            filas, cols = np.nonzero(d <= max_distance)
+            arriba = cols > filas + ini
+            filas, cols = filas[arriba], cols[arriba]
+            distancias = d[filas, cols].tolist()
+            yield "".join(
+                "%s\t%s\t%d\n" % (ids[ini + i], ids[j], dist)
+                for i, j, dist in zip(
+                    filas.tolist(), cols.tolist(), distancias
+                )
             )
-        # si todo ha ido bien tenemos el identificador en el primer grupo
-        id = m.group(1)
-        num_linea = num_linea + 1
-        # la segunda línea es el haplotipo
-        hap = fichero_entrada.readline().strip()
-        # construimos una nueva secuencia
+        if (progress is not None):
+            progress(fin)
+    if (summary is not None):
+        summary.records += n
+        summary.hits += n - len(haplotipos)
+
+
+def expand_compact(stream):
+    """
+    Generador que lee una salida compacta de iter_sequences y devuelve, uno a
+    uno, los registros de la salida completa equivalente.
+    El formato compacto tiene una primera línea de cabecera, la posición base
+    y la referencia alineada como en la salida completa, y por cada muestra su
+    identificación y los tramos "columna:bases" en que difiere de la
+    referencia (línea vacía si no difiere).
+    Parámetros:
+    stream: fichero de datos de entrada (salida compacta)
+    """
+    if (stream.readline() != COMPACT_HEADER):
+        raise HaploException("Data error on input file [Line: 1]\n" +
+                             "Not a compact sequences file")
+    yield stream.readline()
+    yield stream.readline()
+    linea = stream.readline()
+    ref = linea.rstrip("\n").encode("ascii")
+    yield linea
+    num_linea = 5
+    for id in stream:
+        tramos = stream.readline().split()
+        sec = bytearray(ref)
+        for tramo in tramos:
+            col, _, bases = tramo.partition(":")
+            if (not col.isdigit()) or (int(col) + len(bases) > len(sec)):
+                msg = f"Data error on input file [Line: {num_linea + 1}]"
+                raise HaploException(msg + f"\nWrong edit: {tramo}")
+            col = int(col)
+            sec[col:col + len(bases)] = bases.encode("ascii")
+        yield "%s%s\n" % (id, sec.decode("ascii"))
+        num_linea = num_linea + 2
+
+
+def read_pickled(fichero):
+    """
+    Generador que devuelve los objetos guardados con pickle, uno tras otro,
+    en un fichero.
+    """
+    while (True):
         try:
-            a = build_sequence(id, ref, hap)
-        except HaploException as err:
-            msg = f"Data error on input file [Line: {num_linea}]"
-            raise HaploException(msg + "\n" + err.args[0])
-        # escribimos la secuencia en el fichero de salida
-        fichero_salida.write("%s\n" % (a))
-        # incrementamos el número de línea
-        num_linea = num_linea + 1
-    # cerramos los ficheros
-    fichero_entrada.close()
-    fichero_salida.close()
+            yield pickle.load(fichero)
+        except EOFError:
+            break
+
+
+def detect_compression(nom_fichero):
+    """
+    Función que reconoce si un fichero está comprimido por sus primeros bytes.
+    Retorna GZIP, ZSTD ó None si el fichero es texto plano.
+    """
+    with open(nom_fichero, "rb") as f:
+        cabecera = f.read(len(MAGIC_ZSTD))
+    if (cabecera.startswith(MAGIC_GZIP)):
+        return GZIP
+    if (cabecera.startswith(MAGIC_ZSTD)):
+        return ZSTD
+    return None
+
+
+def open_compressed(nom_fichero, mode, compression):
+    """
+    Función que abre en binario un fichero comprimido con gzip ó zstd.
+    """
+    if (compression == GZIP):
+        return gzip.open(nom_fichero, mode, COMPRESS_LEVEL)
+    if (compression != ZSTD):
+        raise HaploException(f"Unknown compression: {compression}")
+    if (zstandard is None):
+        raise HaploException(
+            "Zstandard compressed files need the zstandard package"
+        )
+    f = zstandard.open(nom_fichero, mode)
+    # el lector de zstd no sabe leer por líneas
+    return io.BufferedReader(f) if (mode == "rb") else f
+
+
+def open_input(nom_fichero, binary=False):
+    """
+    Función que abre un fichero de entrada, descomprimiéndolo al vuelo si
+    está comprimido con gzip ó zstd.
+    """
+    compression = detect_compression(nom_fichero)
+    if (compression is None):
+        return open(nom_fichero, "rb" if binary else "r")
+    f = open_compressed(nom_fichero, "rb", compression)
+    return f if binary else io.TextIOWrapper(f)
+
+
+def open_sequences(nom_fichero):
+    """
+    Función que abre un fichero de secuencias: proyectado en memoria si es
+    texto plano, ó con open_input si está comprimido (ó vacío).
+    """
+    if (detect_compression(nom_fichero) is None and
+            os.path.getsize(nom_fichero) > 0):
+        return MappedSequences(nom_fichero)
+    return open_input(nom_fichero)
+
+
+def open_output(nom_fichero, compression=None):
+    """
+    Función que abre un fichero de salida en modo texto, comprimido con
+    gzip ó zstd si se indica.
+    """
+    if (compression is None):
+        return open(nom_fichero, "w", OUTPUT_BUFFER)
+    f = open_compressed(nom_fichero, "wb", compression)
+    return io.TextIOWrapper(io.BufferedWriter(f, OUTPUT_BUFFER))
+
+
+def write_records(fichero_salida, registros, stats=None):
+    """
+    Función que escribe los registros de salida en un fichero. Si se mide,
+    el tiempo de obtener cada registro se carga a la conversión y el de
+    escribirlo a la escritura.
+    """
+    if (stats is None):
+        fichero_salida.writelines(registros)
+        return
+    for texto in stats.iterate("convert", registros):
+        with stats.phase("write"):
+            fichero_salida.write(texto)
+    with stats.phase("write"):
+        fichero_salida.flush()
+
+
+def convert_file(nom_fichero_entrada, nom_fichero_salida, abrir, generar,
+                 compression=None, stats=None):
+    """
+    Función que escribe en un fichero de salida los registros que se generan
+    a partir de un fichero de entrada.
+    Parámetros:
+    nom_fichero_entrada: nombre del fichero de datos de entrada
+    nom_fichero_salida: nombre del fichero de datos de salida
+    abrir: función que abre el fichero de entrada
+    generar: función que recibe el fichero de entrada abierto y devuelve
+        los registros de salida
+    compression: compresión del fichero de salida (GZIP, ZSTD ó None)
+    stats: RunStats donde se miden las fases de la conversión
+    """
+    if (stats is not None):
+        stats.start()
+    with abrir(nom_fichero_entrada) as fichero_entrada, \
+            open_output(nom_fichero_salida, compression) as fichero_salida:
+        write_records(fichero_salida, generar(fichero_entrada), stats)
+    if (stats is not None):
+        stats.stop()
+        stats.phases["read"].bytes = os.path.getsize(nom_fichero_entrada)
+        stats.phases["write"].bytes = os.path.getsize(nom_fichero_salida)
+
+
+def sec2hap(nom_fichero_entrada, nom_fichero_salida, nomenclature, hvri,
+            workers=1, progress=None, compression=None, stats=None):
+    """
+    Función que lee secuencias de un fichero de entrada y construye
+    los haplotipos asociados en base a una referencia, y además los
+    escribe en un fichero de salida.
+    Parámetros:
+    nom_fichero_entrada: nombre del fichero de datos de entrada (secuencias)
+    nom_fichero_salida: nombre del fichero de datos de salida (haplotipos)
+    nomenclature: tipo de nomenclatura (poblaciones ó forense)
+    hvri: indica si los haplotipos se muestran con 3 dígitos o normales
+    workers: número de procesos que convierten las secuencias
+    progress: función a la que se pasa el número de secuencias convertidas
+    compression: compresión del fichero de salida (GZIP, ZSTD ó None)
+    stats: RunStats donde se miden las fases de la conversión
+    Retorna:
+    el resumen (RunSummary) de la conversión
+    """
+    summary = RunSummary()
+    convert_file(
+        nom_fichero_entrada, nom_fichero_salida, open_sequences,
+        lambda f: iter_haplotypes(
+            f, nomenclature, hvri, workers, progress, summary, stats
+        ),
+        compression, stats
+    )
+    return finish_summary(summary, stats)
+
+
+def sec2hap_batch(nom_fichero_entrada, nom_fichero_salida, nomenclature,
+                  hvri, progress=None, batch_size=BATCH_SIZE,
+                  compression=None, stats=None):
+    """
+    Función equivalente a sec2hap que utiliza el motor por lotes.
+    Parámetros:
+    nom_fichero_entrada: nombre del fichero de datos de entrada (secuencias)
+    nom_fichero_salida: nombre del fichero de datos de salida (haplotipos)
+    nomenclature: tipo de nomenclatura (poblaciones ó forense)
+    hvri: indica si los haplotipos se muestran con 3 dígitos o normales
+    progress: función a la que se pasa el número de secuencias convertidas
+    batch_size: número de secuencias que se clasifican a la vez
+    compression: compresión del fichero de salida (GZIP, ZSTD ó None)
+    stats: RunStats donde se miden las fases de la conversión
+    Retorna:
+    el resumen (RunSummary) de la conversión
+    """
+    summary = RunSummary()
+    convert_file(
+        nom_fichero_entrada, nom_fichero_salida, open_sequences,
+        lambda f: iter_haplotypes_batch(
+            f, nomenclature, hvri, progress, batch_size, summary, stats
+        ),
+        compression, stats
+    )
+    return finish_summary(summary, stats)
+
+
+def hap2sec(nom_fichero_entrada, nom_fichero_salida, nomenclature,
+            workers=1, progress=None, compression=None, compact=False,
+            refcache=None, stats=None):
+    """
+    Función que lee haplotipos de un fichero de entrada y construye
+    las secuencias asociadas en base a una referencia, y además las
+    escribe en un fichero de salida.
+    Parámetros:
+    nom_fichero_entrada: nombre del fichero de datos de entrada (haplotipos)
+    nom_fichero_salida: nombre del fichero de datos de salida (secuencias)
+    nomenclature: tipo de nomenclatura (poblaciones ó forense)
+    workers: número de procesos que construyen las secuencias
+    progress: función a la que se pasa el número de secuencias construidas
+    compression: compresión del fichero de salida (GZIP, ZSTD ó None)
+    compact: escribe las secuencias en formato compacto
+    refcache: ReferenceCache con las referencias ya alineadas
+    stats: RunStats donde se miden las fases de la conversión
+    Retorna:
+    el resumen (RunSummary) de la conversión
+    """
+    summary = RunSummary()
+    convert_file(
+        nom_fichero_entrada, nom_fichero_salida, open_input,
+        lambda f: iter_sequences(
+            f, nomenclature, workers, progress, compact, summary, refcache,
+            stats
+        ),
+        compression, stats
+    )
+    return finish_summary(summary, stats)
+
+
+def hap2dist(nom_fichero_entrada, nom_fichero_salida, nomenclature,
+             max_distance=None, progress=None, compression=None, stats=None):
+    """
+    Función que lee haplotipos de un fichero de entrada y escribe en un
+    fichero de salida la matriz de distancias entre ellos (ver
+    iter_distances).
+    Parámetros:
+    nom_fichero_entrada: nombre del fichero de datos de entrada (haplotipos)
+    nom_fichero_salida: nombre del fichero de datos de salida (distancias)
+    nomenclature: tipo de nomenclatura (poblaciones ó forense)
+    max_distance: distancia máxima de los pares que se escriben (ó None
+        para la matriz completa)
+    progress: función a la que se pasa el número de filas calculadas
+    compression: compresión del fichero de salida (GZIP, ZSTD ó None)
+    stats: RunStats donde se miden las fases de la conversión
+    Retorna:
+    el resumen (RunSummary) de la conversión
+    """
+    summary = RunSummary()
+    convert_file(
+        nom_fichero_entrada, nom_fichero_salida, open_input,
+        lambda f: iter_distances(
+            f, nomenclature, max_distance, progress, summary, stats
+        ),
+        compression, stats
+    )
+    return finish_summary(summary, stats)
+
+
+def finish_summary(summary, stats):
+    """Añade al resumen las medidas por fases, si se han tomado."""
+    if (stats is not None):
+        stats.phases["convert"].records = summary.records
+        stats.phases["write"].records = summary.records
+        summary.stats = stats
+    return summary
+
+
+def compact2sec(nom_fichero_entrada, nom_fichero_salida, compression=None):
+    """
+    Función que expande una salida compacta de hap2sec a la salida completa.
+    Parámetros:
+    nom_fichero_entrada: nombre del fichero de entrada (salida compacta)
+    nom_fichero_salida: nombre del fichero de salida (secuencias)
+    compression: compresión del fichero de salida (GZIP, ZSTD ó None)
+    """
+    convert_file(
+        nom_fichero_entrada, nom_fichero_salida, open_input, expand_compact,
+        compression
+    )
 
 
 def manage_haplosearch(
-    inputfile_path, outputfile_path, nomenclature, operation, hvri=False
+    inputfile_path, outputfile_path, nomenclature, operation, hvri=False,
+    batch=False, workers=1, progress=None, compression=None, compact=False,
+    refcache=None, stats=None, max_distance=None
 ):
-    if operation == "S2H":
-        sec2hap(inputfile_path, outputfile_path, nomenclature, hvri)
+    """
+    Función que convierte un fichero de entrada según la operación (S2H,
+    H2S ó H2D, la matriz de distancias entre haplotipos). Si se pasa un
+    RunStats, se miden las fases de la conversión y el resumen devuelto lo
+    incluye.
+    """
+    if operation == "S2H" and batch:
+        return sec2hap_batch(
+            inputfile_path, outputfile_path, nomenclature, hvri, progress,
+            compression=compression, stats=stats
+        )
+    elif operation == "S2H":
+        return sec2hap(
+            inputfile_path, outputfile_path, nomenclature, hvri, workers,
+            progress, compression, stats
+        )
+    elif operation == "H2D":
+        return hap2dist(
+            inputfile_path, outputfile_path, nomenclature, max_distance,
+            progress, compression, stats
+        )
     else:
-        hap2sec(inputfile_path, outputfile_path, nomenclature)
+        return hap2sec(
+            inputfile_path, outputfile_path, nomenclature, workers, progress,
+            compression, compact, refcache, stats
+        )
+
+
+def count_records(inputfile_path):
+    """
+    Función que cuenta los registros (secuencias ó haplotipos) de un fichero
+    de entrada sin contar la secuencia de referencia.
+    """
+    n = 0
+    with open_input(inputfile_path, binary=True) as f:
+        for linea in f:
+            if (linea.lstrip().startswith(b">")):
+                n += 1
+    return max(n - 1, 0)
@@ -0,0 +1,469 @@
+"""
+Índice invertido de mutaciones para buscar en los haplotipos convertidos.
+
+Cada haplotipo se guarda como un Profile con sus mutaciones normalizadas, y
+cada mutación tiene un Posting con la lista ordenada de los perfiles que la
+tienen. Además, cada número de mutaciones tiene un Posting ("#N", ver
+size_key) con los perfiles de ese tamaño, con lo que las búsquedas no
+tienen que consultar el tamaño de cada perfil. Los perfiles se añaden con la
+base de datos bloqueada para escribir (ver lock_index), así que sus
+identificadores son mayores que los existentes y añadir perfiles sólo alarga
+las listas por el final.
+"""
+import heapq
+import sys
+import zlib
+from array import array
+from collections import Counter
+from itertools import accumulate
+
+from django.db import connection, transaction
+from django.db.models import Max
+
+from .exceptions import HaploException
+from .haploutils import (
+    DELETION,
+    INSERTION,
+    TRANSITION,
+    RecordReader,
+    np,
+    open_input,
+    read_haplotypes,
+    read_reference_haplotypes,
+    split_haplotype,
+)
+from .models import Posting, Profile
+
+# tipos de búsqueda: mismas mutaciones, todas las mutaciones (y quizá otras)
+# y los perfiles más cercanos por número de mutaciones distintas
+EXACT = "exact"
+ALL = "all"
+CLOSEST = "closest"
+SEARCH_MODES = (EXACT, ALL, CLOSEST)
+# número de resultados por defecto y máximo
+SEARCH_LIMIT = 10
+SEARCH_MAX_LIMIT = 1000
+# perfiles por inserción y parámetros por consulta (SQLite admite 999)
+INSERT_BATCH = 500
+QUERY_BATCH = 500
+# las listas por tamaño usan claves que no pueden ser mutaciones, que
+# empiezan por su posición: "#" y el carácter siguiente delimitan su rango
+SIZE_PREFIX = "#"
+SIZE_END = "$"
+
+
+def normalize_mutation(mutation, nomenclature):
+    """
+    Notación canónica de una Mutation: la que genera S2H (así, por ejemplo,
+    "3107del" y "3107d" son la misma mutación forense).
+    """
+    pos = mutation.position
+    if (nomenclature == "POP"):
+        if (mutation.type == TRANSITION):
+            return str(pos)
+        if (mutation.type == INSERTION):
+            return f"{pos}i{mutation.base}"
+        if (mutation.type == DELETION):
+            return f"{pos}d{mutation.base}"
+        return f"{pos}{mutation.base}"
+    if (mutation.type == INSERTION):
+        return f"{pos}.{mutation.offset}{mutation.base}"
+    if (mutation.type == DELETION):
+        return f"{pos}d"
+    return f"{pos}{mutation.base}"
+
+
+def normalize_haplotype(haplotipo, nomenclature, ref_id=None):
+    """
+    Mutaciones normalizadas de un haplotipo, sin repetir y ordenadas por
+    posición.
+    """
+    mutations = {
+        normalize_mutation(m, nomenclature): m
+        for m in split_haplotype(haplotipo, ref_id, nomenclature)
+    }
+    return sorted(
+        mutations,
+        key=lambda k: (mutations[k].position, mutations[k].offset, k)
+    )
+
+
+def encode_postings(ids):
+    """Lista ordenada de identificadores -> diferencias comprimidas."""
+    deltas = array("I")
+    anterior = 0
+    for i in ids:
+        deltas.append(i - anterior)
+        anterior = i
+    if (sys.byteorder == "big"):
+        deltas.byteswap()
+    return zlib.compress(deltas.tobytes())
+
+
+def decode_postings(data):
+    """Diferencias comprimidas -> array ordenado de identificadores."""
+    deltas = array("I")
+    deltas.frombytes(zlib.decompress(data))
+    if (sys.byteorder == "big"):
+        deltas.byteswap()
+    if (np is not None):
+        ids = array("I")
+        ids.frombytes(np.cumsum(deltas, dtype=np.uint32).tobytes())
+        return ids
+    return array("I", accumulate(deltas))
+
+
+def size_key(size):
+    """Clave del Posting con los perfiles de un número de mutaciones."""
+    return f"{SIZE_PREFIX}{size}"
+
+
+def batches(elementos, size=QUERY_BATCH):
+    elementos = list(elementos)
+    for ini in range(0, len(elementos), size):
+        yield elementos[ini:ini + size]
+
+
+def add_postings(nomenclature, nuevas):
+    """
+    Añade a las listas de cada mutación los perfiles nuevos (con
+    identificadores mayores que los que ya tienen).
+    """
+    for lote in batches(nuevas):
+        existentes = {
+            mutation: (pk, data) for mutation, pk, data in
+            Posting.objects.filter(
+                nomenclature=nomenclature, mutation__in=lote
+            ).values_list("mutation", "id", "data")
+        }
+        crear = []
+        actualizar = []
+        for mutation in lote:
+            if (mutation in existentes):
+                pk, data = existentes[mutation]
+                ids = decode_postings(data)
+                ids.extend(nuevas[mutation])
+                actualizar.append((len(ids), encode_postings(ids), pk))
+            else:
+                ids = nuevas[mutation]
+                crear.append(Posting(
+                    nomenclature=nomenclature,
+                    mutation=mutation,
+                    count=len(ids),
+                    data=encode_postings(ids),
+                ))
+        Posting.objects.bulk_create(crear)
+        # bulk_update construye una expresión CASE por fila, mucho más lenta
+        # que repetir una misma sentencia UPDATE
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"UPDATE {Posting._meta.db_table} SET count = %s, data = %s "
+                "WHERE id = %s", actualizar
+            )
+
+
+def lock_index():
+    """
+    Toma, al principio de la transacción, el bloqueo de escritura de la base
+    de datos, para que las listas se lean y se amplíen sin que otro proceso
+    añada perfiles a la vez. En SQLite equivale a BEGIN IMMEDIATE: la primera
+    sentencia de escritura espera a que terminen las demás escrituras (en vez
+    de fallar al ampliar una lista ya leída); en otras bases de datos se
+    bloquea la tabla de listas.
+    """
+    tabla = Posting._meta.db_table
+    with connection.cursor() as cursor:
+        if (connection.vendor == "sqlite"):
+            cursor.execute(f"UPDATE {tabla} SET count = count WHERE id = 0")
+        else:
+            cursor.execute(f"LOCK TABLE {tabla} IN EXCLUSIVE MODE")
+
+
+def insert_profiles(perfiles):
+    """
+    Inserta perfiles y retorna sus identificadores, que asigna la base de
+    datos. Si bulk_create no los devuelve (SQLite), se leen: con el índice
+    bloqueado, son los mayores que el último existente.
+    """
+    ultimo = Profile.objects.aggregate(Max("id"))["id__max"] or 0
+    Profile.objects.bulk_create(perfiles)
+    if (all(p.pk is not None for p in perfiles)):
+        return [p.pk for p in perfiles]
+    return list(
+        Profile.objects.filter(pk__gt=ultimo).order_by("id")
+        .values_list("id", flat=True)
+    )
+
+
+def index_profiles(registros, nomenclature, job=None):
+    """
+    Añade perfiles al índice. Los registros se leen antes de bloquear la
+    base de datos, que sólo se bloquea mientras se escriben.
+    Parámetros:
+      registros: iterable de tuplas (muestra, mutaciones normalizadas).
+      nomenclature: tipo de nomenclatura (poblaciones ó forense).
+      job: trabajo del que salen los perfiles (si lo hay).
+    Retorna:
+      el número de perfiles añadidos.
+    """
+    registros = list(registros)
+    with transaction.atomic():
+        lock_index()
+        nuevas = {}
+        for lote in batches(registros, INSERT_BATCH):
+            ids = insert_profiles([
+                Profile(
+                    sample=sample[:255],
+                    nomenclature=nomenclature,
+                    mutations=" ".join(mutations),
+                    size=len(mutations),
+                    job=job,
+                )
+                for sample, mutations in lote
+            ])
+            for pk, (_, mutations) in zip(ids, lote):
+                for mutation in mutations:
+                    nuevas.setdefault(mutation, array("I")).append(pk)
+                clave = size_key(len(mutations))
+                nuevas.setdefault(clave, array("I")).append(pk)
+        add_postings(nomenclature, nuevas)
+    return len(registros)
+
+
+def read_profiles(nom_fichero, nomenclature):
+    """
+    Generador que lee un fichero de haplotipos (que puede venir comprimido)
+    y devuelve tuplas (muestra, mutaciones normalizadas).
+    """
+    with open_input(nom_fichero) as f:
+        lector = RecordReader(f)
+        _, ref = read_reference_haplotypes(lector)
+        for num_linea, id, hap in read_haplotypes(lector):
+            try:
+                mutations = normalize_haplotype(hap, nomenclature, ref.id)
+            except HaploException as err:
+                msg = f"Data error on input file [Line: {num_linea}]"
+                raise HaploException(msg + "\n" + err.args[0])
+            yield id, mutations
+
+
+def index_file(nom_fichero, nomenclature, job=None):
+    """Añade al índice los haplotipos de un fichero."""
+    return index_profiles(
+        read_profiles(nom_fichero, nomenclature), nomenclature, job
+    )
+
+
+def index_job(job):
+    """
+    Añade al índice los haplotipos de un trabajo terminado: la salida de
+    S2H ó la entrada de las demás operaciones.
+    """
+    if (job.operation == "S2H"):
+        return index_file(job.output_path, job.nomenclature, job)
+    return index_file(job.input_path, job.nomenclature, job)
+
+
+def load_postings(mutations, nomenclature):
+    """Listas de perfiles de las mutaciones que están en el índice."""
+    listas = {}
+    for lote in batches(mutations):
+        for mutation, data in Posting.objects.filter(
+            nomenclature=nomenclature, mutation__in=lote
+        ).values_list("mutation", "data"):
+            listas[mutation] = decode_postings(data)
+    return listas
+
+
+def load_sizes(nomenclature):
+    """Listas de perfiles por número de mutaciones: tamaño -> ids."""
+    postings = Posting.objects.filter(
+        nomenclature=nomenclature,
+        mutation__gte=SIZE_PREFIX,
+        mutation__lt=SIZE_END,
+    ).values_list("mutation", "data")
+    return {
+        int(mutation[len(SIZE_PREFIX):]): decode_postings(data)
+        for mutation, data in postings
+    }
+
+
+def size_table(tamanos):
+    """
+    Tabla identificador -> número de mutaciones, a partir de las listas por
+    tamaño (los identificadores que no son perfiles quedan a 0).
+    """
+    ultimo = max((ids[-1] for ids in tamanos.values() if ids), default=0)
+    tabla = array("i", bytes(4 * (ultimo + 1)))
+    for size, ids in tamanos.items():
+        for pk in ids:
+            tabla[pk] = size
+    return tabla
+
+
+def intersect_postings(claves, nomenclature):
+    """Perfiles que están en las listas de todas las claves."""
+    listas = load_postings(claves, nomenclature)
+    if (len(listas) < len(claves)):
+        return []
+    # se parte de la lista más corta
+    listas = sorted(listas.values(), key=len)
+    comunes = set(listas[0])
+    for ids in listas[1:]:
+        if (not comunes):
+            break
+        comunes.intersection_update(ids)
+    return sorted(comunes)
+
+
+def search_all(mutations, nomenclature):
+    """Perfiles que tienen todas las mutaciones (y quizá otras)."""
+    if (not mutations):
+        return list(
+            Profile.objects.filter(nomenclature=nomenclature)
+            .order_by("id").values_list("id", flat=True)
+        )
+    return intersect_postings(mutations, nomenclature)
+
+
+def search_exact(mutations, nomenclature):
+    """
+    Perfiles que tienen exactamente esas mutaciones: todas ellas y ninguna
+    más, es decir, que están también en la lista de su número.
+    """
+    return intersect_postings(
+        list(mutations) + [size_key(len(mutations))], nomenclature
+    )
+
+
+def count_shared(listas):
+    """
+    Número de mutaciones de la consulta que tiene cada perfil, a partir de
+    las listas de sus mutaciones.
+    """
+    comunes = Counter()
+    for ids in listas:
+        comunes.update(ids)
+    return comunes
+
+
+def push_closest(mejores, k, distancia, pk):
+    """
+    Guarda un perfil entre los k más cercanos (montículo de máximos, con
+    los empates resueltos por identificador).
+    """
+    elemento = (-distancia, -pk)
+    if (len(mejores) < k):
+        heapq.heappush(mejores, elemento)
+    elif (elemento > mejores[0]):
+        heapq.heapreplace(mejores, elemento)
+
+
+def closest_numpy(listas, tamanos, n, k):
+    """
+    search_closest con NumPy: la distancia de todos los perfiles se calcula
+    de una vez en una tabla indexada por identificador (n + tamaño, menos
+    2 por cada lista de la consulta en la que está el perfil).
+    """
+    tamanos = {size: ids for size, ids in tamanos.items() if ids}
+    if (not tamanos):
+        return []
+    ids = np.concatenate(
+        [np.frombuffer(lista, dtype=np.uint32) for lista in tamanos.values()]
+    ).astype(np.int64)
+    ultimo = int(ids.max())
+    distancias = np.zeros(ultimo + 1, dtype=np.int64)
+    distancias[ids] = n + np.repeat(
+        list(tamanos), [len(lista) for lista in tamanos.values()]
+    )
+    if (listas):
+        todos = np.concatenate(
+            [np.frombuffer(lista, dtype=np.uint32) for lista in listas]
+        )
+        distancias -= 2 * np.bincount(todos, minlength=ultimo + 1)
+    # los empates se resuelven por identificador
+    claves = distancias[ids] * (ultimo + 1) + ids
+    if (len(claves) > k):
+        claves = claves[np.argpartition(claves, k - 1)[:k]]
+    return [
+        (int(c) // (ultimo + 1), int(c) % (ultimo + 1))
+        for c in np.sort(claves)
+    ]
+
+
+def search_closest(mutations, nomenclature, k):
+    """
+    Los k perfiles más cercanos, como tuplas (distancia, identificador). La
+    distancia es el número de mutaciones que sólo tiene uno de los dos:
+    n + tamaño - 2 x comunes, para una consulta de n mutaciones. Los
+    tamaños salen de las listas por tamaño, sin consultar los perfiles.
+    Sin NumPy, los perfiles se recorren de más a menos mutaciones comunes,
+    y después los que no tienen ninguna de menor a mayor tamaño, hasta que
+    ninguno de los que quedan puede estar más cerca (ya que
+    tamaño >= comunes).
+    """
+    n = len(mutations)
+    listas = list(load_postings(mutations, nomenclature).values())
+    tamanos = load_sizes(nomenclature)
+    if (np is not None):
+        return closest_numpy(listas, tamanos, n, k)
+    comunes = count_shared(listas)
+    tabla = size_table(tamanos)
+    grupos = {}
+    for pk, c in comunes.items():
+        grupos.setdefault(c, []).append(pk)
+    mejores = []
+    for c in sorted(grupos, reverse=True):
+        if (len(mejores) == k and n - c > -mejores[0][0]):
+            break
+        for pk in grupos[c]:
+            push_closest(mejores, k, n + tabla[pk] - 2 * c, pk)
+    for size in sorted(tamanos):
+        distancia = n + size
+        if (len(mejores) == k and distancia > -mejores[0][0]):
+            break
+        # en cada tamaño los perfiles van por identificador creciente
+        for pk in tamanos[size]:
+            if (len(mejores) == k and (-distancia, -pk) <= mejores[0]):
+                break
+            if (pk not in comunes):
+                push_closest(mejores, k, distancia, pk)
+    return sorted((-d, -pk) for d, pk in mejores)
+
+
+def search_profiles(query, nomenclature, mode=ALL, limit=SEARCH_LIMIT):
+    """
+    Busca en el índice los perfiles de un haplotipo.
+    Parámetros:
+      query: haplotipo (mutaciones separadas por espacios).
+      nomenclature: tipo de nomenclatura (poblaciones ó forense).
+      mode: tipo de búsqueda (EXACT, ALL ó CLOSEST).
+      limit: número máximo de perfiles que se devuelven.
+    Retorna:
+      diccionario con la consulta normalizada, el total de perfiles
+      encontrados y los primeros de ellos.
+    """
+    mutations = normalize_haplotype(query, nomenclature)
+    distancias = {}
+    if (mode == CLOSEST):
+        cercanos = search_closest(mutations, nomenclature, limit)
+        ids = [i for _, i in cercanos]
+        distancias = {i: d for d, i in cercanos}
+    elif (mode == EXACT):
+        ids = search_exact(mutations, nomenclature)
+    else:
+        ids = search_all(mutations, nomenclature)
+    perfiles = Profile.objects.in_bulk(ids[:limit])
+    resultados = []
+    for i in ids[:limit]:
+        resultado = perfiles[i].as_dict()
+        if (mode == CLOSEST):
+            resultado["distance"] = distancias[i]
+        resultados.append(resultado)
+    return {
+        "query": mutations,
+        "mode": mode,
+        "nomenclature": nomenclature,
+        "total": len(ids),
+        "results": resultados,
+    }
@@ -0,0 +1,268 @@
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from . import metrics
+from .exceptions import HaploException
+from .haploutils import (
+    ReferenceCache,
+    RunStats,
+    count_records,
+    manage_haplosearch,
+    np,
+)
+from .index import index_job
+from .models import Job
+from .utils import handle_uploaded_file
+
+logger = logging.getLogger(__name__)
+
+# segundos mínimos entre dos actualizaciones del progreso en la base de datos
+PROGRESS_INTERVAL = 0.5
+
+_executor = None
+_refcache = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        if settings.HAPLOSEARCH_TRACE_MEMORY and not trace_memory():
+            logger.warning(
+                "HAPLOSEARCH_TRACE_MEMORY is ignored with %d job threads",
+                settings.HAPLOSEARCH_JOB_THREADS,
+            )
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.HAPLOSEARCH_JOB_THREADS,
+            thread_name_prefix="haplosearch-job",
+        )
+    return _executor
+
+
+def trace_memory():
+    """
+    Si se mide la memoria de los trabajos. tracemalloc mide todo el proceso,
+    así que sólo se usa si los trabajos se ejecutan de uno en uno.
+    """
+    return (
+        settings.HAPLOSEARCH_TRACE_MEMORY
+        and settings.HAPLOSEARCH_JOB_THREADS == 1
+    )
+
+
+def get_refcache():
+    """Caché de referencias alineadas (None si está desactivada)."""
+    global _refcache
+    if _refcache is None and settings.HAPLOSEARCH_REFCACHE_DIR:
+        _refcache = ReferenceCache(
+            settings.HAPLOSEARCH_REFCACHE_DIR,
+            settings.HAPLOSEARCH_REFCACHE_SIZE,
+        )
+    return _refcache
+
+
+def job_paths(job_id):
+    """Rutas de los ficheros de entrada y salida de un trabajo."""
+    os.makedirs(settings.HAPLOSEARCH_JOBS_DIR, exist_ok=True)
+    base = os.path.join(settings.HAPLOSEARCH_JOBS_DIR, str(job_id))
+    return base + ".in", base + ".out"
+
+
+def create_job(uploaded_file, operation, nomenclature, hvri, compression="",
+               compact=False, max_distance=None):
+    """
+    Guarda el fichero subido (que puede venir comprimido) y crea un trabajo
+    pendiente para convertirlo.
+    """
+    job = Job(
+        operation=operation,
+        nomenclature=nomenclature,
+        hvri=hvri,
+        compression=compression,
+        compact=compact and operation == "H2S",
+        max_distance=max_distance if operation == "H2D" else None,
+    )
+    job.input_path, job.output_path = job_paths(job.id)
+    handle_uploaded_file(uploaded_file, job.input_path)
+    job.save()
+    return job
+
+
+def submit_job(job):
+    """Encola un trabajo en el pool local de ejecución."""
+    remove_expired_jobs()
+    return get_executor().submit(run_job, job.pk)
+
+
+def register_download(job, ini, fin, size):
+    """
+    Anota que se han enviado los bytes [ini, fin] de la salida de un trabajo
+    y la borra cuando se ha descargado entera. Sólo cuentan los rangos que
+    continúan lo ya descargado desde el byte 0 (descarga completa ó
+    reanudada); las salidas descargadas a saltos las borra remove_expired_jobs.
+    """
+    Job.objects.filter(
+        pk=job.pk, downloaded__gte=ini, downloaded__lte=fin
+    ).update(downloaded=fin + 1)
+    if (Job.objects.filter(pk=job.pk, downloaded__gte=size).exists()):
+        remove_file(job.output_path)
+
+
+def remove_expired_jobs():
+    """
+    Borra los ficheros de los trabajos terminados hace más de
+    HAPLOSEARCH_JOBS_EXPIRE horas (y deja su salida sin ruta).
+    Retorna:
+      el número de trabajos cuyos ficheros se han borrado.
+    """
+    limite = timezone.now() - timedelta(hours=settings.HAPLOSEARCH_JOBS_EXPIRE)
+    jobs = Job.objects.filter(finished__lt=limite).exclude(output_path="")
+    n = 0
+    for job in jobs:
+        remove_file(job.input_path)
+        remove_file(job.output_path)
+        Job.objects.filter(pk=job.pk).update(output_path="")
+        n += 1
+    return n
+
+
+def record_metrics(job, stats):
+    """Suma a las métricas del proceso los registros y bytes de un trabajo."""
+    metrics.records_total.inc(
+        job.operation, job.nomenclature, amount=job.records_done
+    )
+    metrics.input_bytes.inc(job.operation, amount=stats.phases["read"].bytes)
+    metrics.output_bytes.inc(
+        job.operation, amount=stats.phases["write"].bytes
+    )
+
+
+def remove_file(path):
+    """Borra un fichero de un trabajo, si existe."""
+    if path and os.path.exists(path):
+        os.remove(path)
+
+
+def fail_job(job_id, message):
+    """
+    Marca un trabajo como fallido y borra sus ficheros. Se usa cuando el
+    error no viene de la conversión (base de datos, ficheros, etc.).
+    """
+    try:
+        job = Job.objects.get(pk=job_id)
+        remove_file(job.input_path)
+        remove_file(job.output_path)
+        Job.objects.filter(pk=job_id).update(
+            status=Job.FAILED, message=message, finished=timezone.now()
+        )
+    except Exception:
+        logger.exception("Job %s could not be marked as failed", job_id)
+
+
+def fail_stale_jobs():
+    """
+    Marca como fallidos los trabajos pendientes ó en curso, que al arrancar
+    el servidor ya no va a terminar nadie (se ejecutaban en memoria).
+    Retorna:
+      el número de trabajos marcados.
+    """
+    n = 0
+    for job in Job.objects.filter(status__in=(Job.PENDING, Job.RUNNING)):
+        fail_job(job.pk, "Interrupted by a server restart")
+        n += 1
+    return n
+
+
+def run_job(job_id):
+    """
+    Ejecuta la conversión de un trabajo, actualizando su estado y progreso.
+    Cualquier error deja el trabajo como fallido.
+    """
+    close_old_connections()
+    metrics.jobs_in_flight.inc()
+    try:
+        execute_job(job_id)
+    except Exception as e:
+        logger.exception("Job %s failed", job_id)
+        metrics.errors_total.inc(metrics.error_category(e))
+        fail_job(job_id, str(e))
+    finally:
+        metrics.jobs_in_flight.dec()
+        close_old_connections()
+
+
+def execute_job(job_id):
+    """Conversión de un trabajo (ver run_job)."""
+    job = Job.objects.get(pk=job_id)
+    jobs = Job.objects.filter(pk=job_id)
+    job.status = Job.RUNNING
+    job.started = timezone.now()
+    job.records_total = count_records(job.input_path)
+    job.save(update_fields=["status", "started", "records_total"])
+
+    ultima = [0.0]
+
+    def progress(n):
+        ahora = time.monotonic()
+        if ahora - ultima[0] >= PROGRESS_INTERVAL:
+            ultima[0] = ahora
+            jobs.update(records_done=n)
+
+    stats = RunStats(trace_memory=trace_memory())
+    inicio = time.perf_counter()
+    try:
+        summary = manage_haplosearch(
+            job.input_path,
+            job.output_path,
+            job.nomenclature,
+            job.operation,
+            job.hvri,
+            batch=settings.HAPLOSEARCH_BATCH and np is not None,
+            workers=settings.HAPLOSEARCH_WORKERS,
+            progress=progress,
+            compression=job.compression or None,
+            compact=job.compact,
+            refcache=get_refcache(),
+            stats=stats,
+            max_distance=job.max_distance,
+        )
+    except Exception as e:
+        if not isinstance(e, HaploException):
+            logger.exception("Job %s failed", job_id)
+        job.status = Job.FAILED
+        job.message = str(e)
+        metrics.errors_total.inc(metrics.error_category(e))
+        remove_file(job.output_path)
+    else:
+        job.status = Job.DONE
+        job.records_done = summary.records
+        job.duplicates = summary.hits
+        job.stats = json.dumps(stats.as_dict())
+        logger.info(
+            "Job %s %s-%s: %s; %s", job_id, job.operation,
+            job.nomenclature, summary, stats
+        )
+        record_metrics(job, stats)
+        if settings.HAPLOSEARCH_INDEX_JOBS:
+            try:
+                index_job(job)
+            except Exception:
+                logger.exception("Job %s could not be indexed", job_id)
+    finally:
+        remove_file(job.input_path)
+    metrics.jobs_total.inc(job.operation, job.nomenclature, job.status)
+    metrics.job_duration.observe(
+        time.perf_counter() - inicio, job.operation, job.nomenclature
+    )
+    job.finished = timezone.now()
+    job.save(update_fields=[
+        "status", "message", "records_done", "duplicates", "stats",
+        "finished"
+    ])
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from app.exceptions import HaploException
+from app.haploutils import GZIP, ZSTD, compact2sec
+
+
+class Command(BaseCommand):
+    help = "Expand a compact H2S output file to the full sequences format"
+
+    def add_arguments(self, parser):
+        parser.add_argument("inputfile", help="compact file (may be compressed)")
+        parser.add_argument("outputfile", help="file with the full sequences")
+        parser.add_argument(
+            "--compression",
+            choices=(GZIP, ZSTD),
+            help="compress the output file",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            compact2sec(
+                options["inputfile"],
+                options["outputfile"],
+                options["compression"],
+            )
+        except HaploException as e:
+            raise CommandError(e)
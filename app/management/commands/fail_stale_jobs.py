@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from app.jobs import fail_stale_jobs
+
+
+class Command(BaseCommand):
+    help = "Mark pending and running jobs as failed (before starting the server)"
+
+    def handle(self, *args, **options):
+        n = fail_stale_jobs()
+        self.stdout.write(f"{n} stale jobs marked as failed")
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from app.exceptions import HaploException
+from app.index import index_file
+
+
+class Command(BaseCommand):
+    help = "Add the haplotypes of a file to the mutation search index"
+
+    def add_arguments(self, parser):
+        parser.add_argument("inputfile", help="haplotypes file (may be compressed)")
+        parser.add_argument(
+            "--nomenclature",
+            choices=("POP", "FOR"),
+            default="POP",
+            help="nomenclature of the haplotypes",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            n = index_file(options["inputfile"], options["nomenclature"])
+        except HaploException as e:
+            raise CommandError(e)
+        self.stdout.write(f"{n} profiles indexed")
@@ -0,0 +1,175 @@
+"""
+Métricas de los trabajos en formato de texto de Prometheus.
+
+El registro vive en cada proceso del servidor, así que todas las muestras
+llevan la etiqueta pid para poder sumar los procesos al consultarlas.
+"""
+import os
+import threading
+
+from .exceptions import HaploException
+
+# límites (segundos) de los intervalos del histograma de duración
+DURATION_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# categorías de error según el principio del mensaje de HaploException
+ERROR_CATEGORIES = (
+    ("Syntax error", "syntax"),
+    ("Base position is not defined", "header"),
+    ("Sequence has not the same number of bases", "length"),
+    ("Unknown notation", "notation"),
+    ("Position out of reference", "position"),
+    ("Not a compact sequences file", "format"),
+    ("Unknown compression", "compression"),
+    ("Zstandard compressed files", "compression"),
+)
+
+
+def error_category(error):
+    """
+    Categoría de un error de conversión. Los errores de datos ("Data error
+    on input file [Line: N]") se clasifican por su causa, en la última línea.
+    """
+    if not isinstance(error, HaploException):
+        return "internal"
+    msg = str(error)
+    if msg.startswith("Data error"):
+        msg = msg.splitlines()[-1]
+    for prefijo, categoria in ERROR_CATEGORIES:
+        if msg.startswith(prefijo):
+            return categoria
+    return "other"
+
+
+def format_labels(nombres, valores, extra=()):
+    pares = list(zip(nombres, valores)) + list(extra)
+    if not pares:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in pares
+    )
+
+
+class Metric:
+    """Métrica con etiquetas; cada combinación de valores es una serie."""
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def render(self, extra):
+        lineas = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        with self.lock:
+            series = sorted(self.series.items())
+        for valores, valor in series:
+            lineas.extend(self.render_series(valores, valor, extra))
+        return lineas
+
+    def render_series(self, valores, valor, extra):
+        etiquetas = format_labels(self.labels, valores, extra)
+        return [f"{self.name}{etiquetas} {valor:g}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *valores, amount=1):
+        with self.lock:
+            self.series[valores] = self.series.get(valores, 0) + amount
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, *valores, amount=1):
+        self.inc(*valores, amount=-amount)
+
+    def set(self, valor, *valores):
+        with self.lock:
+            self.series[valores] = valor
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, valor, *valores):
+        with self.lock:
+            cuentas, suma = self.series.get(
+                valores, ([0] * (len(self.buckets) + 1), 0.0)
+            )
+            for i, limite in enumerate(self.buckets):
+                if valor <= limite:
+                    cuentas[i] += 1
+            cuentas[-1] += 1
+            self.series[valores] = (cuentas, suma + valor)
+
+    def render_series(self, valores, valor, extra):
+        cuentas, suma = valor
+        lineas = []
+        limites = [f"{b:g}" for b in self.buckets] + ["+Inf"]
+        for limite, cuenta in zip(limites, cuentas):
+            etiquetas = format_labels(
+                self.labels + ("le",), valores + (limite,), extra
+            )
+            lineas.append(f"{self.name}_bucket{etiquetas} {cuenta}")
+        etiquetas = format_labels(self.labels, valores, extra)
+        lineas.append(f"{self.name}_sum{etiquetas} {suma:g}")
+        lineas.append(f"{self.name}_count{etiquetas} {cuentas[-1]}")
+        return lineas
+
+
+jobs_total = Counter(
+    "haplosearch_jobs_total", "Finished jobs.",
+    ("operation", "nomenclature", "status"),
+)
+job_duration = Histogram(
+    "haplosearch_job_duration_seconds", "Duration of the finished jobs.",
+    ("operation", "nomenclature"),
+)
+records_total = Counter(
+    "haplosearch_records_total", "Records converted by the finished jobs.",
+    ("operation", "nomenclature"),
+)
+input_bytes = Counter(
+    "haplosearch_input_bytes_total", "Bytes read by the finished jobs.",
+    ("operation",),
+)
+output_bytes = Counter(
+    "haplosearch_output_bytes_total", "Bytes written by the finished jobs.",
+    ("operation",),
+)
+errors_total = Counter(
+    "haplosearch_errors_total", "Failed jobs by error category.",
+    ("category",),
+)
+jobs_in_flight = Gauge(
+    "haplosearch_jobs_in_flight", "Jobs running in this process.",
+)
+# un proceso recién arrancado informa de 0 trabajos, no de ninguna serie
+jobs_in_flight.set(0)
+REGISTRY = (
+    jobs_total, job_duration, records_total, input_bytes, output_bytes,
+    errors_total, jobs_in_flight,
+)
+
+
+def render():
+    """Texto con todas las métricas del proceso."""
+    extra = (("pid", os.getpid()),)
+    lineas = []
+    for metrica in REGISTRY:
+        lineas.extend(metrica.render(extra))
+    return "\n".join(lineas) + "\n"
@@ -0,0 +1,18 @@
+# Generated by Django 2.2 on 2026-10-18 14:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='compression',
+            field=models.CharField(blank=True, max_length=3),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2 on 2026-10-18 14:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_job_compression'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='compact',
+            field=models.BooleanField(default=False),
+        ),
+    ]
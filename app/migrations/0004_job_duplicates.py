@@ -0,0 +1,18 @@
+# Generated by Django 2.2 on 2026-10-18 14:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0003_job_compact'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='duplicates',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
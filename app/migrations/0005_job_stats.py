@@ -0,0 +1,18 @@
+# Generated by Django 2.2 on 2026-10-18 14:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0004_job_duplicates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='stats',
+            field=models.TextField(blank=True),
+        ),
+    ]
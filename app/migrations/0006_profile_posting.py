@@ -0,0 +1,43 @@
+# Generated by Django 2.2 on 2026-10-18 14:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_job_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Profile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sample', models.CharField(max_length=255)),
+                ('nomenclature', models.CharField(max_length=3)),
+                ('mutations', models.TextField(blank=True)),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('job', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='app.Job')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Posting',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nomenclature', models.CharField(max_length=3)),
+                ('mutation', models.CharField(max_length=255)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('data', models.BinaryField()),
+            ],
+            options={
+                'unique_together': {('nomenclature', 'mutation')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='profile',
+            index=models.Index(fields=['nomenclature', 'size'], name='app_profile_nomencl_6db9f0_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2 on 2026-10-18 15:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_profile_posting'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='max_distance',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
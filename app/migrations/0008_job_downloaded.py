@@ -0,0 +1,18 @@
+# Generated by Django 2.2 on 2026-10-18 18:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_job_max_distance'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='downloaded',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
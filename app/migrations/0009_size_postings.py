@@ -0,0 +1,36 @@
+from django.db import migrations
+
+from app.index import SIZE_END, SIZE_PREFIX, encode_postings, size_key
+
+
+def add_size_postings(apps, schema_editor):
+    """Listas por tamaño de los perfiles ya indexados."""
+    Profile = apps.get_model('app', 'Profile')
+    Posting = apps.get_model('app', 'Posting')
+    listas = {}
+    perfiles = Profile.objects.order_by('id').values_list(
+        'id', 'nomenclature', 'size')
+    for pk, nomenclature, size in perfiles.iterator():
+        listas.setdefault((nomenclature, size), []).append(pk)
+    Posting.objects.bulk_create([
+        Posting(nomenclature=nomenclature, mutation=size_key(size),
+                count=len(ids), data=encode_postings(ids))
+        for (nomenclature, size), ids in listas.items()
+    ])
+
+
+def remove_size_postings(apps, schema_editor):
+    Posting = apps.get_model('app', 'Posting')
+    Posting.objects.filter(
+        mutation__gte=SIZE_PREFIX, mutation__lt=SIZE_END).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_job_downloaded'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_size_postings, remove_size_postings),
+    ]
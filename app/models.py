@@ -1,3 +1,153 @@
+import json
+import uuid
+
 from django.db import models
+from django.utils import timezone
+
+
+class Job(models.Model):
+    """
+    Conversión de un fichero subido, que se ejecuta en segundo plano.
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = (
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    operation = models.CharField(max_length=3)
+    nomenclature = models.CharField(max_length=3)
+    hvri = models.BooleanField(default=False)
+    compression = models.CharField(max_length=3, blank=True)
+    compact = models.BooleanField(default=False)
+    max_distance = models.PositiveIntegerField(null=True, blank=True)
+    status = models.CharField(max_length=7, choices=STATUS_CHOICES, default=PENDING)
+    message = models.TextField(blank=True)
+    input_path = models.CharField(max_length=255)
+    output_path = models.CharField(max_length=255)
+    # bytes de la salida descargados de forma continua desde el principio
+    downloaded = models.BigIntegerField(default=0)
+    records_total = models.PositiveIntegerField(default=0)
+    records_done = models.PositiveIntegerField(default=0)
+    duplicates = models.PositiveIntegerField(default=0)
+    stats = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ("-created",)
+
+    def __str__(self):
+        return f"{self.operation} {self.nomenclature} [{self.status}]"
+
+    @property
+    def output_filename(self):
+        if self.operation == "H2D":
+            filename = "distances.tsv"
+        elif self.compact:
+            filename = "output.compact.txt"
+        else:
+            filename = "output.txt"
+        if self.compression:
+            return f"{filename}.{self.compression}"
+        return filename
+
+    @property
+    def duplicate_rate(self):
+        """Porcentaje de registros resueltos como repetidos de otros."""
+        if not self.records_done:
+            return 0.0
+        return 100 * self.duplicates / self.records_done
+
+    @property
+    def phases(self):
+        """Medidas por fase de la conversión (ver RunStats.as_dict)."""
+        if not self.stats:
+            return []
+        fases = json.loads(self.stats)["phases"]
+        return [dict(fase, name=nombre) for nombre, fase in fases.items()]
+
+    @property
+    def peak_memory(self):
+        """Pico de memoria de la conversión (si se ha medido)."""
+        if not self.stats:
+            return None
+        return json.loads(self.stats)["peak_memory"]
+
+    @property
+    def is_finished(self):
+        return self.status in (self.DONE, self.FAILED)
+
+    @property
+    def elapsed_time(self):
+        """Segundos de ejecución (hasta ahora si todavía no ha acabado)."""
+        if self.started is None:
+            return None
+        return ((self.finished or timezone.now()) - self.started).total_seconds()
+
+    def as_dict(self):
+        return {
+            "id": str(self.id),
+            "status": self.status,
+            "message": self.message,
+            "records_done": self.records_done,
+            "records_total": self.records_total,
+            "duplicates": self.duplicates,
+            "elapsed_time": self.elapsed_time,
+        }
+
+
+class Profile(models.Model):
+    """
+    Haplotipo guardado en el índice de búsqueda, con sus mutaciones
+    normalizadas (ver app/index.py).
+    """
+
+    sample = models.CharField(max_length=255)
+    nomenclature = models.CharField(max_length=3)
+    mutations = models.TextField(blank=True)
+    size = models.PositiveIntegerField(default=0)
+    job = models.ForeignKey(
+        Job, null=True, blank=True, on_delete=models.SET_NULL
+    )
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["nomenclature", "size"])]
+
+    def __str__(self):
+        return f"{self.sample} [{self.nomenclature}]"
+
+    def as_dict(self):
+        return {
+            "id": self.pk,
+            "sample": self.sample,
+            "mutations": self.mutations,
+            "job": str(self.job_id) if self.job_id else None,
+        }
+
+
+class Posting(models.Model):
+    """
+    Lista de los perfiles que tienen una mutación: identificadores
+    ordenados, guardados como diferencias comprimidas con zlib.
+    """
+
+    nomenclature = models.CharField(max_length=3)
+    mutation = models.CharField(max_length=255)
+    count = models.PositiveIntegerField(default=0)
+    data = models.BinaryField()
+
+    class Meta:
+        unique_together = ("nomenclature", "mutation")
 
-# Create your models here.
+    def __str__(self):
+        return f"{self.mutation} [{self.nomenclature}]: {self.count}"
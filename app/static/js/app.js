@@ -1,5 +1,5 @@
 // Generated by CoffeeScript 1.10.0
-var back_to_top, handle_download, handle_hvri, handle_process, handle_scroll;
+var back_to_top, handle_compact, handle_download, handle_hvri, handle_process, handle_scroll, poll_job;
 
 $(function() {
   $("#process").on("submit", handle_process);
@@ -8,7 +8,12 @@ $(function() {
   $("#back-to-top").on("click", back_to_top);
   $("#back-to-top").tooltip("show");
   $("#id_operation").on("change", handle_hvri);
-  return $("#id_nomenclature").on("change", handle_hvri);
+  $("#id_nomenclature").on("change", handle_hvri);
+  $("#id_operation").on("change", handle_compact);
+  handle_compact();
+  if ($("#job").length) {
+    return poll_job();
+  }
 });
 
 handle_process = function(event) {
@@ -48,3 +53,33 @@ handle_hvri = function(event) {
     return $("#hvri-row").hide();
   }
 };
+
+handle_compact = function(event) {
+  if ($("#id_operation").val() === "H2S") {
+    $("#compact-row").show();
+  } else {
+    $("#compact-row").hide();
+  }
+  if ($("#id_operation").val() === "H2D") {
+    return $("#max-distance-row").show();
+  } else {
+    return $("#max-distance-row").hide();
+  }
+};
+
+poll_job = function() {
+  return $.getJSON($("#job").data("status-url"), function(job) {
+    var percent;
+    if (job.status === "done" || job.status === "failed") {
+      location.reload();
+      return;
+    }
+    if (job.records_total > 0) {
+      percent = Math.round(100 * job.records_done / job.records_total);
+      $("#job_progress").css("width", percent + "%");
+    }
+    $("#job_records").text(job.records_done + " / " + job.records_total);
+    $("#job_elapsed").text((job.elapsed_time || 0).toFixed(1));
+    return setTimeout(poll_job, 1000);
+  });
+};
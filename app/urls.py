@@ -4,10 +4,19 @@ from django.conf.urls.static import static
 
 from . import views
 
+JOB_ID = (r'(?P<job_id>[0-9a-f]{8}-[0-9a-f]{4}-'
+          r'[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})')
+
 urlpatterns = [
     url(r'^$', views.index, name='index'),
     url(r'^start/$', views.start, name='start'),
-    url(r'^download/$', views.download, name='download'),
+    url(r'^jobs/' + JOB_ID + r'/$', views.job, name='job'),
+    url(r'^jobs/' + JOB_ID + r'/status/$', views.job_status,
+        name='job_status'),
+    url(r'^jobs/' + JOB_ID + r'/download/$', views.download,
+        name='download'),
+    url(r'^search/$', views.search, name='search'),
+    url(r'^metrics/$', views.metrics, name='metrics'),
     url(r'^help/$', views.help, name='help'),
 ]
 
@@ -1,3 +1,11 @@
+import re
+
+# tamaño de los bloques en los que se envían los ficheros de salida
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+RE_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
 def handle_uploaded_file(f, path):
     with open(path, 'wb+') as destination:
         for chunk in f.chunks():
@@ -18,22 +26,70 @@ def listtoranges(l):
     """
     ini = 0
     fin = 0
-    rango = '['
+    rangos = []
     while (fin < len(l)):
         # mientras el siguiente sea igual al anterior + 1
         while ((fin + 1 < len(l)) and (l[fin + 1] == l[fin] + 1)):
             fin = fin + 1
         # aquí tenemos un rango
         if (ini != fin):
-            rango = rango + ('%03d-%03d, ' % (l[ini], l[fin]))
+            rangos.append('%03d-%03d' % (l[ini], l[fin]))
         # aquí tenemos un valor aislado
         else:
-            rango = rango + ('%03d, ' % (l[ini]))
+            rangos.append('%03d' % (l[ini]))
         # incrementar final
         fin = fin + 1
         # avanzar inicio
         ini = fin
-    # eliminar la última coma y añadir un corchete
-    rango = rango[:len(rango) - 2] + ']'
-    # retornar el rango
-    return rango
+    # retornar los rangos separados por comas y entre corchetes
+    return '[' + ', '.join(rangos) + ']'
+
+
+def parse_range(header, size):
+    """
+    Función que interpreta la cabecera HTTP Range de una petición.
+    Parámetros:
+        header: valor de la cabecera (ó None).
+        size: tamaño en bytes del fichero.
+    Retorna:
+        una tupla (inicio, fin) con el rango de bytes (fin incluido), ó
+        None si se debe enviar el fichero completo.
+    Lanza ValueError si el rango no se puede satisfacer.
+    EJEMPLO:
+        entrada: 'bytes=10-', 100
+        salida: (10, 99)
+    """
+    # sólo se atiende un único rango; en otro caso se envía todo
+    m = RE_RANGE.match(header or "")
+    if (m is None) or (m.group(1) == m.group(2) == ""):
+        return None
+    ini, fin = m.groups()
+    # rango de sufijo: los últimos bytes del fichero
+    if (ini == ""):
+        ini, fin = max(size - int(fin), 0), size - 1
+    else:
+        ini = int(ini)
+        fin = size - 1 if (fin == "") else min(int(fin), size - 1)
+    if (ini >= size) or (ini > fin):
+        raise ValueError(header)
+    return ini, fin
+
+
+def stream_file(path, ini, fin, on_complete=None,
+                chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Generador que devuelve en bloques los bytes [ini, fin] de un fichero.
+    Si se da on_complete, se llama sólo cuando se ha enviado todo el rango;
+    si el cliente corta la descarga, no se llama.
+    """
+    with open(path, "rb") as f:
+        f.seek(ini)
+        restante = fin - ini + 1
+        while (restante > 0):
+            bloque = f.read(min(chunk_size, restante))
+            if (not bloque):
+                break
+            restante -= len(bloque)
+            yield bloque
+    if (on_complete is not None) and (restante == 0):
+        on_complete()
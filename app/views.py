@@ -1,12 +1,20 @@
-from django.shortcuts import render
-from django.http import HttpResponse
-from tempfile import mktemp
+from django.shortcuts import get_object_or_404, redirect, render
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_http_methods
 import os
-import time
+from . import metrics as job_metrics
 from .forms import HaploSearchForm
-from .utils import handle_uploaded_file
-from .haploutils import manage_haplosearch
 from .exceptions import HaploException
+from .haploutils import GZIP, ZSTD
+from .index import SEARCH_LIMIT, SEARCH_MAX_LIMIT, SEARCH_MODES, search_profiles
+from .jobs import create_job, register_download, submit_job
+from .models import Job
+from .utils import parse_range, stream_file
+
+CONTENT_TYPES = {
+    GZIP: "application/gzip",
+    ZSTD: "application/zstd",
+}
 
 
 def index(request):
@@ -14,56 +22,104 @@ def index(request):
 
 
 def start(request):
-    error, msg, outputfile_path, elapsed_time = False, None, None, None
     if request.method == "POST":
         form = HaploSearchForm(request.POST, request.FILES)
         if form.is_valid():
-            inputfile = form.cleaned_data["inputfile"]
-            operation = form.cleaned_data["operation"]
-            nomenclature = form.cleaned_data["nomenclature"]
-            hvri = form.cleaned_data["hvri"]
-            inputfile_path, outputfile_path = mktemp(), mktemp()
-            handle_uploaded_file(inputfile, inputfile_path)
-            try:
-                start = time.time()
-                manage_haplosearch(
-                    inputfile_path,
-                    outputfile_path,
-                    nomenclature,
-                    operation,
-                    hvri
-                )
-                end = time.time()
-                elapsed_time = (end - start)
-            except (HaploException, Exception) as e:
-                error = True
-                msg = e
-                os.remove(outputfile_path)
-            finally:
-                os.remove(inputfile_path)
+            job = create_job(
+                form.cleaned_data["inputfile"],
+                form.cleaned_data["operation"],
+                form.cleaned_data["nomenclature"],
+                form.cleaned_data["hvri"],
+                form.cleaned_data["compression"],
+                form.cleaned_data["compact"],
+                form.cleaned_data["max_distance"]
+            )
+            submit_job(job)
+            return redirect("job", job_id=job.pk)
     else:
         form = HaploSearchForm()
+    return render(request, "start.html", {"form": form})
+
+
+def job(request, job_id):
+    job = get_object_or_404(Job, pk=job_id)
     return render(
         request,
         "start.html",
         {
-            "form": form,
-            "error": error,
-            "msg": msg,
-            "outputfile_path": outputfile_path,
-            "elapsed_time": elapsed_time
+            "form": HaploSearchForm(),
+            "job": job
         }
     )
 
 
-def download(request):
-    filepath = request.POST["filepath"]
-    filecontent = open(filepath)
-    os.remove(filepath)
-    response = HttpResponse(filecontent, content_type="text/plain")
-    response["Content-Disposition"] = "attachment; filename=output.txt"
+def job_status(request, job_id):
+    job = get_object_or_404(Job, pk=job_id)
+    return JsonResponse(job.as_dict())
+
+
+@require_http_methods(["GET", "POST"])
+def download(request, job_id):
+    job = get_object_or_404(Job, pk=job_id, status=Job.DONE)
+    try:
+        size = os.path.getsize(job.output_path)
+    except FileNotFoundError:
+        return HttpResponse(status=410)
+    try:
+        rango = parse_range(request.META.get("HTTP_RANGE"), size)
+    except ValueError:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = "bytes */%d" % size
+        return response
+    ini, fin = rango or (0, size - 1)
+    # el fichero se borra cuando se ha descargado entero (ver register_download)
+    response = StreamingHttpResponse(
+        stream_file(
+            job.output_path, ini, fin,
+            on_complete=lambda: register_download(job, ini, fin, size)
+        ),
+        content_type=CONTENT_TYPES.get(job.compression, "text/plain"),
+        status=206 if rango else 200
+    )
+    response["Content-Length"] = fin - ini + 1
+    response["Accept-Ranges"] = "bytes"
+    if rango:
+        response["Content-Range"] = "bytes %d-%d/%d" % (ini, fin, size)
+    response["Content-Disposition"] = "attachment; filename=%s" % (
+        job.output_filename
+    )
     return response
 
 
+def search(request):
+    """
+    Búsqueda en el índice de mutaciones: q (haplotipo), nomenclature (POP ó
+    FOR), mode (exact, all ó closest) y limit. Devuelve JSON.
+    """
+    nomenclature = request.GET.get("nomenclature", "POP")
+    mode = request.GET.get("mode", "all")
+    try:
+        limit = int(request.GET.get("limit", SEARCH_LIMIT))
+    except ValueError:
+        limit = 0
+    if nomenclature not in ("POP", "FOR") or mode not in SEARCH_MODES or \
+            not 0 < limit <= SEARCH_MAX_LIMIT:
+        return JsonResponse({"error": "Wrong search parameters"}, status=400)
+    try:
+        resultado = search_profiles(
+            request.GET.get("q", ""), nomenclature, mode, limit
+        )
+    except HaploException as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    return JsonResponse(resultado)
+
+
+def metrics(request):
+    """Métricas de los trabajos de este proceso, para Prometheus."""
+    return HttpResponse(
+        job_metrics.render(), content_type="text/plain; version=0.0.4"
+    )
+
+
 def help(request):
     return render(request, "help.html")
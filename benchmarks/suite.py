@@ -0,0 +1,193 @@
+"""
+Benchmark de S2H y H2S sobre mitogenomas sintéticos.
+
+Genera con benchmarks/synthetic.py ficheros de tamaño creciente y mide,
+para cada nomenclatura, sec2hap (y el motor por lotes si NumPy está
+instalado) y hap2sec. Cada medida se ejecuta en un proceso nuevo para
+obtener su pico de memoria (RSS). Informa de registros por segundo, pico
+de RSS y exponente de escalado (pendiente log-log del tiempo frente al
+número de muestras), y puede guardar los resultados como referencia en JSON
+ó compararlos con una referencia guardada.
+
+Uso:
+    python benchmarks/suite.py [--sizes 250,1000,4000] [--save FICHERO]
+                               [--compare FICHERO] [--tolerance 0.25]
+"""
+import argparse
+import datetime
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+import synthetic  # noqa: E402
+from app.haploutils import manage_haplosearch, np  # noqa: E402
+
+BASELINE_PATH = os.path.join(BASE_DIR, "benchmarks", "baseline.json")
+SIZES = (250, 1000, 4000)
+
+
+def peak_rss():
+    """Pico de memoria residente del proceso, en bytes."""
+    # en Linux ru_maxrss se hereda del padre a través de fork y exec, así que
+    # se lee el pico propio de /proc
+    try:
+        with open("/proc/self/status") as f:
+            for linea in f:
+                if (linea.startswith("VmHWM:")):
+                    return int(linea.split()[1]) * 1024
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux lo da en KiB y macOS en bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def run_case(inputfile_path, nomenclature, operation, batch):
+    """Ejecuta una conversión y devuelve su tiempo y su pico de memoria."""
+    with tempfile.TemporaryDirectory() as tmp:
+        inicio = time.perf_counter()
+        summary = manage_haplosearch(
+            inputfile_path, os.path.join(tmp, "output"), nomenclature,
+            operation, batch=batch
+        )
+        segundos = time.perf_counter() - inicio
+    return {
+        "records": summary.records,
+        "seconds": segundos,
+        "records_per_sec": summary.records / segundos,
+        "peak_rss_mb": peak_rss() / 2 ** 20,
+    }
+
+
+def measure(contexto, *args):
+    """Ejecuta run_case en un proceso nuevo."""
+    with contexto.Pool(1) as pool:
+        return pool.apply(run_case, args)
+
+
+def scaling(resultados):
+    """Pendiente log-log del tiempo frente al número de registros."""
+    puntos = [(math.log(r["records"]), math.log(r["seconds"]))
+              for r in resultados if r["seconds"] > 0]
+    if (len(puntos) < 2):
+        return None
+    mx = sum(x for x, _ in puntos) / len(puntos)
+    my = sum(y for _, y in puntos) / len(puntos)
+    sxx = sum((x - mx) ** 2 for x, _ in puntos)
+    sxy = sum((x - mx) * (y - my) for x, y in puntos)
+    return sxy / sxx if sxx else None
+
+
+def run_suite(sizes, columns, seed, repeat):
+    casos = [("S2H", "POP", False), ("S2H", "FOR", False)]
+    if (np is not None):
+        casos.append(("S2H", "FOR", True))
+    casos += [("H2S", "POP", False), ("H2S", "FOR", False)]
+    contexto = multiprocessing.get_context("spawn")
+    resultados = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for samples in sizes:
+            entradas = {"S2H": os.path.join(tmp, "sequences.txt")}
+            synthetic.write(entradas["S2H"], samples, columns, seed)
+            # los haplotipos de H2S son la salida de S2H del mismo fichero
+            for nomenclature in ("POP", "FOR"):
+                entradas[nomenclature] = os.path.join(tmp, nomenclature)
+                manage_haplosearch(
+                    entradas["S2H"], entradas[nomenclature], nomenclature,
+                    "S2H"
+                )
+            for operation, nomenclature, batch in casos:
+                nombre = f"{operation}-{nomenclature}" + ("-batch" * batch)
+                entrada = entradas[
+                    "S2H" if operation == "S2H" else nomenclature
+                ]
+                # nos quedamos con la ejecución más rápida
+                r = min(
+                    (measure(contexto, entrada, nomenclature, operation,
+                             batch)
+                     for _ in range(repeat)),
+                    key=lambda r: r["seconds"]
+                )
+                resultados.setdefault(nombre, []).append(r)
+                print(f"{nombre:<14}{samples:>8} samples"
+                      f"{r['records_per_sec']:>12,.0f} records/s"
+                      f"{r['peak_rss_mb']:>10.1f} MiB")
+    return {
+        "meta": {
+            "date": datetime.date.today().isoformat(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "numpy": np is not None,
+            "sizes": list(sizes),
+            "columns": columns,
+            "seed": seed,
+        },
+        "results": resultados,
+        "scaling": {
+            nombre: scaling(r) for nombre, r in resultados.items()
+        },
+    }
+
+
+def compare(actual, referencia, tolerance):
+    """
+    Compara los registros por segundo con los de una referencia.
+    Retorna:
+      el número de medidas más lentas que la referencia más la tolerancia.
+    """
+    regresiones = 0
+    for nombre, resultados in actual["results"].items():
+        anteriores = {
+            r["records"]: r for r in referencia["results"].get(nombre, [])
+        }
+        for r in resultados:
+            anterior = anteriores.get(r["records"])
+            if (anterior is None):
+                continue
+            ratio = r["records_per_sec"] / anterior["records_per_sec"]
+            lento = ratio < 1 - tolerance
+            regresiones += lento
+            print(f"{nombre:<14}{r['records']:>8} samples"
+                  f"{ratio:>9.2f}x" + ("  REGRESSION" if lento else ""))
+    return regresiones
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)))
+    parser.add_argument("--columns", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--save", metavar="FICHERO")
+    parser.add_argument("--compare", metavar="FICHERO", nargs="?",
+                        const=BASELINE_PATH)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+    sizes = [int(n) for n in args.sizes.split(",")]
+    actual = run_suite(sizes, args.columns, args.seed, args.repeat)
+    for nombre, exponente in actual["scaling"].items():
+        if (exponente is not None):
+            print(f"{nombre:<14} scaling exponent {exponente:.2f}")
+    if (args.save):
+        with open(args.save, "w") as f:
+            json.dump(actual, f, indent=2)
+            f.write("\n")
+    if (args.compare):
+        with open(args.compare) as f:
+            referencia = json.load(f)
+        if (compare(actual, referencia, args.tolerance)):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
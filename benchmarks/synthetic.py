@@ -0,0 +1,140 @@
+"""
+Generador determinista de mitogenomas sintéticos.
+
+Parte de la rCRS de app/static/files y escribe un fichero de secuencias
+alineadas (entrada de S2H) con N muestras de L columnas. Cada muestra recibe,
+en promedio, tasa x L eventos de cada tipo: transiciones, transversiones,
+deleciones, inserciones (en un conjunto común de posiciones, para que todas
+las muestras compartan el alineamiento), heteroplasmias y tramos de N.
+Con la misma semilla se obtiene siempre el mismo fichero.
+
+Uso:
+    python benchmarks/synthetic.py salida.txt [--samples N] [--columns L]
+"""
+import argparse
+import os
+import random
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RCRS_PATH = os.path.join(
+    BASE_DIR, "app", "static", "files", "mtDNA.haplotypes.population.txt"
+)
+
+TRANSICION = {"A": "G", "G": "A", "C": "T", "T": "C"}
+TRANSVERSION = {"A": "CT", "G": "CT", "C": "AG", "T": "AG"}
+HETEROPLASMIAS = {"A": "RWM", "G": "RSK", "C": "YSM", "T": "YWK"}
+
+# eventos por columna y muestra
+RATES = {
+    "transition": 2e-3,
+    "transversion": 2e-4,
+    "deletion": 1e-4,
+    "insertion": 1e-4,
+    "heteroplasmy": 1e-4,
+    "nrun": 5e-5,
+}
+# longitud máxima de las inserciones y de los tramos de N
+MAX_INSERTION = 3
+MAX_NRUN = 20
+
+
+def read_rcrs():
+    """Devuelve la rCRS (sin huecos) del fichero de haplotipos de ejemplo."""
+    with open(RCRS_PATH) as f:
+        f.readline()
+        f.readline()
+        return f.readline().strip().upper()
+
+
+def events(rng, rate, columns):
+    """Número de eventos de una muestra (binomial aproximada)."""
+    media = rate * columns
+    n = int(media)
+    if (rng.random() < media - n):
+        n = n + 1
+    return n
+
+
+def generate(samples, columns=None, seed=0, rates=None):
+    """
+    Genera un fichero de secuencias alineadas.
+    Parámetros:
+      samples: número de muestras.
+      columns: número de bases de la referencia (por defecto, la rCRS
+      completa).
+      seed: semilla del generador.
+      rates: tasas de cada tipo de evento (ver RATES).
+    Retorna:
+      lista con las líneas del fichero (sin saltos de línea).
+    """
+    rng = random.Random(seed)
+    tasas = dict(RATES, **(rates or {}))
+    ref = read_rcrs()
+    if (columns):
+        ref = ref[:columns]
+    n = len(ref)
+    # posiciones comunes de inserción (columna tras la que se inserta) y
+    # huecos que se reservan tras cada una
+    sitios = max(1, int(tasas["insertion"] * n * 20))
+    inserciones = {
+        p: rng.randint(1, MAX_INSERTION)
+        for p in rng.sample(range(n), min(sitios, n))
+    }
+    # columna de cada base en la referencia alineada
+    columna = []
+    partes = []
+    c = 0
+    for i, base in enumerate(ref):
+        columna.append(c)
+        partes.append(base + "-" * inserciones.get(i, 0))
+        c = c + len(partes[-1])
+    ref_alineada = "".join(partes)
+    lineas = ["START: 1", ">CRS", ref_alineada]
+    for k in range(samples):
+        sec = list(ref_alineada)
+        for _ in range(events(rng, tasas["transition"], n)):
+            i = rng.randrange(n)
+            sec[columna[i]] = TRANSICION[ref[i]]
+        for _ in range(events(rng, tasas["transversion"], n)):
+            i = rng.randrange(n)
+            sec[columna[i]] = rng.choice(TRANSVERSION[ref[i]])
+        for _ in range(events(rng, tasas["heteroplasmy"], n)):
+            i = rng.randrange(n)
+            sec[columna[i]] = rng.choice(HETEROPLASMIAS[ref[i]])
+        for _ in range(events(rng, tasas["deletion"], n)):
+            sec[columna[rng.randrange(n)]] = "-"
+        for _ in range(events(rng, tasas["insertion"], n)):
+            i = rng.choice(list(inserciones))
+            for j in range(rng.randint(1, inserciones[i])):
+                sec[columna[i] + 1 + j] = rng.choice("ACGT")
+        for _ in range(events(rng, tasas["nrun"], n)):
+            i = rng.randrange(n)
+            for j in range(i, min(n, i + rng.randint(1, MAX_NRUN))):
+                sec[columna[j]] = "N"
+        lineas.append(">sample%06d" % (k))
+        lineas.append("".join(sec))
+    return lineas
+
+
+def write(path, samples, columns=None, seed=0, rates=None):
+    with open(path, "w") as f:
+        for linea in generate(samples, columns, seed, rates):
+            f.write(linea + "\n")
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("output")
+    parser.add_argument("--samples", type=int, default=1000)
+    parser.add_argument("--columns", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    for nombre, tasa in RATES.items():
+        parser.add_argument(f"--{nombre}", type=float, default=tasa)
+    args = parser.parse_args()
+    rates = {nombre: getattr(args, nombre) for nombre in RATES}
+    write(args.output, args.samples, args.columns, args.seed, rates)
+
+
+if __name__ == "__main__":
+    main()
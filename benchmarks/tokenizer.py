@@ -0,0 +1,104 @@
+"""
+Micro-benchmark del separador de mutaciones.
+
+Compara, sobre los haplotipos de app/static/files, el separador anterior
+(una expresión regular por notación, compilada en cada llamada) con el
+actual de una sola pasada, con y sin la caché de notaciones.
+
+Uso:
+    python benchmarks/tokenizer.py [--repeat N]
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from app.haploutils import (  # noqa: E402
+    split_mutation_forensic,
+    split_mutation_population,
+)
+
+FILES_PATH = os.path.join(BASE_DIR, "app", "static", "files")
+FIXTURES = {
+    "POP": os.path.join(FILES_PATH, "mtDNA.haplotypes.population.txt"),
+    "FOR": os.path.join(FILES_PATH, "mtDNA.haplotypes.forensic.txt"),
+}
+
+
+def legacy_split_population(mutation):
+    m = re.compile(r"^\d+$").match(mutation)
+    if (m):
+        return {"type": "T", "position": int(m.group(0)), "base": ""}
+    m = re.compile(r"^(\d+)([ATGCRYSWKMBDHVN])$").match(mutation)
+    if (m):
+        return {"type": "V", "position": int(m.group(1)), "base": m.group(2)}
+    m = re.compile(r"^(\d+)i([ATGC]+)$").match(mutation)
+    if (m):
+        return {"type": "I", "position": int(m.group(1)), "base": m.group(2)}
+    m = re.compile(r"^(\d+)d([ATGC]+)$").match(mutation)
+    if (m):
+        return {"type": "D", "position": int(m.group(1)), "base": m.group(2)}
+    raise ValueError(mutation)
+
+
+def legacy_split_forensic(mutation):
+    m = re.compile(r"^(\d+)([ATGCRYSWKMBDHVN])$").match(mutation)
+    if (m):
+        return {"type": "V", "position": int(m.group(1)), "offset": 0,
+                "base": m.group(2)}
+    m = re.compile(r"^(\d+)\.(\d+)([ATGC])$").match(mutation)
+    if (m):
+        return {"type": "I", "position": int(m.group(1)),
+                "offset": int(m.group(2)), "base": m.group(3)}
+    m = re.compile(r"^(\d+)(del|d)$").match(mutation)
+    if (m):
+        return {"type": "D", "position": int(m.group(1)), "offset": 0,
+                "base": "-"}
+    raise ValueError(mutation)
+
+
+def read_tokens(path):
+    """Devuelve las mutaciones de todos los haplotipos de un fichero."""
+    with open(path) as f:
+        lineas = f.read().splitlines()
+    # los haplotipos iguales a la referencia se indican con su identificador
+    ref_id = lineas[1].lstrip(" >")
+    haplotipos = [h for h in lineas[4::2] if h != ref_id]
+    return [t for h in haplotipos for t in h.split()]
+
+
+def tokens_per_second(split, tokens, repeat):
+    inicio = time.perf_counter()
+    for _ in range(repeat):
+        for t in tokens:
+            split(t)
+    return len(tokens) * repeat / (time.perf_counter() - inicio)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+    separadores = {
+        "POP": (legacy_split_population, split_mutation_population),
+        "FOR": (legacy_split_forensic, split_mutation_forensic),
+    }
+    for nomenclature, (legacy, split) in separadores.items():
+        tokens = read_tokens(FIXTURES[nomenclature])
+        resultados = (
+            ("before", legacy),
+            ("single pass", split.__wrapped__),
+            ("single pass + cache", split),
+        )
+        print(f"{nomenclature} ({len(tokens)} tokens x {args.repeat})")
+        for nombre, funcion in resultados:
+            tps = tokens_per_second(funcion, tokens, args.repeat)
+            print(f"  {nombre:<22}{tps:>14,.0f} tokens/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.11/ref/settings/
 """
 
 import os
+import tempfile
 
 from prettyconf import config
 
@@ -80,6 +81,8 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # seconds a writer waits for another one (e.g. two jobs indexing)
+        'OPTIONS': {'timeout': 30},
     }
 }
 
@@ -128,6 +131,52 @@ STATICFILES_DIRS = [os.path.join(BASE_DIR, 'node_modules')]
 
 CRISPY_TEMPLATE_PACK = 'bootstrap3'
 
+# Number of processes used to convert the records of each uploaded file
+HAPLOSEARCH_WORKERS = config('HAPLOSEARCH_WORKERS', default='1', cast=int)
+
+# Convert sequences to haplotypes with the NumPy batch engine. It is only used
+# when NumPy is installed (pip install haplosearch[fast]); otherwise the regular
+# engine runs with HAPLOSEARCH_WORKERS processes. It is off by default: it is
+# about 20% faster but needs about twice the memory (benchmarks/baseline.json).
+HAPLOSEARCH_BATCH = config(
+    'HAPLOSEARCH_BATCH', default='False', cast=config.boolean)
+
+# Background threads that run the uploaded conversions (per server process)
+HAPLOSEARCH_JOB_THREADS = config(
+    'HAPLOSEARCH_JOB_THREADS', default='2', cast=int)
+
+# Folder where the input and output files of each job are stored
+HAPLOSEARCH_JOBS_DIR = config(
+    'HAPLOSEARCH_JOBS_DIR',
+    default=os.path.join(tempfile.gettempdir(), 'haplosearch-jobs'))
+
+# Hours after which the files of a finished job are removed, if its output has
+# not been fully downloaded before
+HAPLOSEARCH_JOBS_EXPIRE = config(
+    'HAPLOSEARCH_JOBS_EXPIRE', default='24', cast=int)
+
+# Folder and maximum size (bytes) of the cache of aligned references used by
+# H2S jobs. An empty folder disables the cache.
+HAPLOSEARCH_REFCACHE_DIR = config(
+    'HAPLOSEARCH_REFCACHE_DIR',
+    default=os.path.join(tempfile.gettempdir(), 'haplosearch-refs'))
+HAPLOSEARCH_REFCACHE_SIZE = config(
+    'HAPLOSEARCH_REFCACHE_SIZE', default=str(64 * 1024 * 1024), cast=int)
+
+# Measure the memory peak of each phase of a job with tracemalloc (slow). As
+# tracemalloc traces the whole process, it is ignored when
+# HAPLOSEARCH_JOB_THREADS is greater than 1.
+HAPLOSEARCH_TRACE_MEMORY = config(
+    'HAPLOSEARCH_TRACE_MEMORY', default='False', cast=config.boolean)
+
+# Add the haplotypes of finished jobs to the mutation search index
+HAPLOSEARCH_INDEX_JOBS = config(
+    'HAPLOSEARCH_INDEX_JOBS', default='False', cast=config.boolean)
+
+# Level of the job messages (summaries, warnings) written to stderr. The
+# logfile only keeps errors.
+HAPLOSEARCH_LOG_LEVEL = config('HAPLOSEARCH_LOG_LEVEL', default='INFO')
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -139,6 +188,10 @@ LOGGING = {
         },
     },
     'handlers': {
+        'console': {
+            'formatter': 'verbose',
+            'class': 'logging.StreamHandler',
+        },
         'logfile': {
             'level': 'ERROR',
             'formatter': 'verbose',
@@ -146,6 +199,7 @@ LOGGING = {
             'filename': 'haplosearch.log',
             'maxBytes': 1 * 1024 * 1024,
             'backupCount': 3,
+            'delay': True,
         },
     },
     'loggers': {
@@ -154,5 +208,10 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        'app': {
+            'handlers': ['console', 'logfile'],
+            'level': HAPLOSEARCH_LOG_LEVEL,
+            'propagate': True,
+        },
     },
 }
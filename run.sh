@@ -2,4 +2,6 @@
 
 cd $(dirname $0)
 source .venv/bin/activate
+# los trabajos en curso se ejecutaban en memoria y ya no van a terminar
+python manage.py fail_stale_jobs
 exec gunicorn -b unix:/tmp/haplosearch.sock main.wsgi:application
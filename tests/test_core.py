@@ -1,10 +1,42 @@
 import filecmp
+import importlib
+import io
 import os
+import tracemalloc
+from datetime import timedelta
 from tempfile import mktemp
 
+import pytest
+
 from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.urls import reverse
+from django.utils import timezone
 
-from app.haploutils import manage_haplosearch
+from app import metrics
+from app.exceptions import HaploException
+from app.jobs import create_job, remove_expired_jobs, run_job, trace_memory
+from app.index import index_file, search_profiles
+from app.models import Job, Profile
+from app.haploutils import (
+    GZIP,
+    ZSTD,
+    Adn,
+    Mutation,
+    ReferenceCache,
+    RunStats,
+    add_insertions,
+    count_records,
+    iter_haplotypes,
+    iter_sequences,
+    manage_haplosearch,
+    open_compressed,
+    open_input,
+    split_mutation_forensic,
+    split_haplotype,
+    split_mutation_population,
+)
 
 TESTFILES_PATH = os.path.join(settings.BASE_DIR, 'app/static/files')
 # test file with haplotypes in nomenclature forensic genetics
@@ -45,3 +77,448 @@ def test_seq_to_happop():
     cmp = filecmp.cmp(TESTFILE_HAP_POP, outputfile_path)
     os.remove(outputfile_path)
     assert cmp
+
+
+def test_position_index_follows_gaps():
+    ref = Adn('CRS', 'ACGTACGTAC')
+    ref.align(1, {3: 2, 7: 1})
+    assert ref.getseq_asstring() == 'ACG--TACG-TAC'
+    assert ref.column(3, 2) == 4
+    assert ref.column(4) == 5
+    # los huecos ya alineados se reutilizan
+    ref.align(1, {3: 1, 7: 2})
+    assert ref.getseq_asstring() == 'ACG--TACG--TAC'
+    assert ref.column(8) == 11
+
+
+def test_align_single_pass():
+    ref = Adn('CRS', 'ACGTACGTAC')
+    insertions = {}
+    for hap in ('3iTT 7iA', '3iC 10iG'):
+        add_insertions(insertions, split_haplotype(hap, 'CRS', 'POP'), 'POP')
+    ref.align(1, insertions)
+    assert ref.getseq_asstring() == 'ACG--TACG-TAC-'
+    assert list(ref.posref) == [1, 2, 3, 3, 3, 4, 5, 6, 7, 7, 8, 9, 10, 10]
+    assert ref.column(8) == 10
+
+
+def test_seq_to_hap_batch():
+    pytest.importorskip('numpy')
+    outputfile_path = mktemp()
+    manage_haplosearch(
+        TESTFILE_SEQ, outputfile_path, 'POP', 'S2H', True, batch=True
+    )
+    cmp_pop = filecmp.cmp(TESTFILE_HAP_POP, outputfile_path)
+    manage_haplosearch(TESTFILE_SEQ, outputfile_path, 'FOR', 'S2H', batch=True)
+    cmp_for = filecmp.cmp(TESTFILE_HAP_FOR, outputfile_path)
+    os.remove(outputfile_path)
+    assert cmp_pop and cmp_for
+
+
+class UnseekableStream(io.StringIO):
+    def seekable(self):
+        return False
+
+
+def test_iter_pipeline_from_streams():
+    with open(TESTFILE_SEQ) as f:
+        sequences = f.read()
+    with open(TESTFILE_HAP_FOR) as f:
+        haplotypes = f.read()
+    stream = UnseekableStream(haplotypes)
+    assert ''.join(iter_sequences(stream, 'FOR')) == sequences
+    stream = io.StringIO(sequences)
+    assert ''.join(iter_haplotypes(stream, 'FOR')) == haplotypes
+
+
+def test_split_mutation_records():
+    assert split_mutation_population('309iCC') == Mutation('I', 309, 0, 'CC')
+    assert split_mutation_forensic('16193.1C') == Mutation('I', 16193, 1, 'C')
+    assert split_mutation_forensic('263G') is split_mutation_forensic('263G')
+    with pytest.raises(HaploException, match='Unknown notation: 263X'):
+        split_mutation_population('263X')
+
+
+def test_parallel_conversion_keeps_order():
+    outputfile_path = mktemp()
+    manage_haplosearch(
+        TESTFILE_SEQ, outputfile_path, 'FOR', 'S2H', workers=2
+    )
+    cmp_s2h = filecmp.cmp(TESTFILE_HAP_FOR, outputfile_path)
+    manage_haplosearch(
+        TESTFILE_HAP_POP, outputfile_path, 'POP', 'H2S', workers=2
+    )
+    cmp_h2s = filecmp.cmp(TESTFILE_SEQ, outputfile_path)
+    os.remove(outputfile_path)
+    assert cmp_s2h and cmp_h2s
+
+
+def test_parallel_conversion_reports_line():
+    with open(TESTFILE_HAP_FOR) as f:
+        haplotypes = f.read().replace('16518T 16519C', '16518T 99999C')
+    stream = io.StringIO(haplotypes)
+    with pytest.raises(HaploException, match=r'\[Line: 13\]'):
+        ''.join(iter_sequences(stream, 'FOR', workers=2))
+
+
+@pytest.mark.django_db
+def test_job_runs_and_reports_status(client, settings, tmp_path):
+    settings.HAPLOSEARCH_JOBS_DIR = str(tmp_path)
+    with open(TESTFILE_SEQ, 'rb') as f:
+        upload = SimpleUploadedFile('seq.txt', f.read())
+    job = create_job(upload, 'S2H', 'FOR', False)
+    run_job(job.pk)
+
+    status = client.get(reverse('job_status', args=[job.pk])).json()
+    assert status['status'] == 'done'
+    assert status['records_done'] == status['records_total'] > 0
+    response = client.get(reverse('job', args=[job.pk]))
+    assert b'id="phases"' in response.content
+    assert not os.path.exists(job.input_path)
+    response = client.post(reverse('download', args=[job.pk]))
+    assert b''.join(response) == open(TESTFILE_HAP_FOR, 'rb').read()
+
+
+@pytest.mark.django_db
+def test_broken_and_stale_jobs_fail(settings, tmp_path):
+    settings.HAPLOSEARCH_JOBS_DIR = str(tmp_path)
+    job = create_job(SimpleUploadedFile('seq.txt', b'>CRS\nACGT\n'),
+                     'S2H', 'FOR', False)
+    os.remove(job.input_path)
+    run_job(job.pk)
+    job.refresh_from_db()
+    assert job.status == Job.FAILED and job.finished is not None
+
+    job = create_job(SimpleUploadedFile('seq.txt', b'>CRS\nACGT\n'),
+                     'S2H', 'FOR', False)
+    call_command('fail_stale_jobs')
+    job.refresh_from_db()
+    assert job.status == Job.FAILED
+    assert not os.path.exists(job.input_path)
+
+
+@pytest.mark.django_db
+def test_download_ranges_keep_file_until_complete(client, settings, tmp_path):
+    settings.HAPLOSEARCH_JOBS_DIR = str(tmp_path)
+    with open(TESTFILE_HAP_POP, 'rb') as f:
+        contenido = f.read()
+    upload = SimpleUploadedFile('hap.txt', contenido)
+    job = create_job(upload, 'H2S', 'POP', False)
+    run_job(job.pk)
+    url = reverse('download', args=[job.pk])
+    with open(TESTFILE_SEQ, 'rb') as f:
+        esperado = f.read()
+
+    # el final del fichero sin el principio no completa la descarga
+    response = client.get(url, HTTP_RANGE='bytes=-10')
+    assert b''.join(response.streaming_content) == esperado[-10:]
+    assert os.path.exists(job.output_path)
+
+    response = client.get(url, HTTP_RANGE='bytes=0-99')
+    assert response.status_code == 206
+    assert response['Content-Range'] == 'bytes 0-99/%d' % len(esperado)
+    parcial = b''.join(response.streaming_content)
+    assert os.path.exists(job.output_path)
+
+    response = client.get(url, HTTP_RANGE='bytes=100-')
+    assert response.status_code == 206
+    assert parcial + b''.join(response.streaming_content) == esperado
+    assert not os.path.exists(job.output_path)
+    assert client.get(url).status_code == 410
+
+
+@pytest.mark.django_db
+def test_expired_jobs_are_removed(settings, tmp_path):
+    settings.HAPLOSEARCH_JOBS_DIR = str(tmp_path)
+    with open(TESTFILE_HAP_POP, 'rb') as f:
+        upload = SimpleUploadedFile('hap.txt', f.read())
+    job = create_job(upload, 'H2S', 'POP', False)
+    run_job(job.pk)
+    assert remove_expired_jobs() == 0
+    Job.objects.filter(pk=job.pk).update(
+        finished=timezone.now() - timedelta(hours=settings.HAPLOSEARCH_JOBS_EXPIRE + 1))
+    assert remove_expired_jobs() == 1
+    assert not os.listdir(str(tmp_path))
+    assert remove_expired_jobs() == 0
+
+
+@pytest.mark.django_db
+def test_metrics_count_jobs_and_errors(client, settings, tmp_path):
+    settings.HAPLOSEARCH_JOBS_DIR = str(tmp_path)
+    with open(TESTFILE_SEQ, 'rb') as f:
+        run_job(create_job(SimpleUploadedFile('seq.txt', f.read()),
+                           'S2H', 'POP', False).pk)
+    upload = SimpleUploadedFile('hap.txt', b'START: 1\n>CRS\nACGT\n>A\n5Z\n')
+    run_job(create_job(upload, 'H2S', 'POP', False).pk)
+
+    response = client.get(reverse('metrics'))
+    assert response['Content-Type'].startswith('text/plain')
+    texto = response.content.decode()
+    pid = 'pid="%d"' % os.getpid()
+    assert ('haplosearch_job_duration_seconds_count{operation="S2H",'
+            'nomenclature="POP",%s}' % pid) in texto
+    assert 'haplosearch_errors_total{category="notation",%s}' % pid in texto
+    assert 'haplosearch_jobs_in_flight{%s} 0' % pid in texto
+
+
+def test_metrics_report_no_jobs_in_flight_at_start():
+    importlib.reload(metrics)
+    pid = 'pid="%d"' % os.getpid()
+    assert 'haplosearch_jobs_in_flight{%s} 0\n' % pid in metrics.render()
+
+
+@pytest.mark.django_db
+def test_finished_jobs_are_indexed_and_searched(client, settings, tmp_path):
+    settings.HAPLOSEARCH_JOBS_DIR = str(tmp_path)
+    settings.HAPLOSEARCH_INDEX_JOBS = True
+    with open(TESTFILE_SEQ, 'rb') as f:
+        contenido = f.read()
+    for _ in range(2):
+        run_job(create_job(SimpleUploadedFile('seq.txt', contenido),
+                           'S2H', 'FOR', False).pk)
+    with open(TESTFILE_HAP_FOR) as f:
+        haplotipo = f.read().splitlines()[4]
+    url = reverse('search')
+
+    def search(q, mode):
+        return client.get(url, {'q': q, 'nomenclature': 'FOR',
+                                'mode': mode}).json()
+
+    exact = search(haplotipo.replace('3107d', '3107del'), 'exact')
+    assert exact['total'] == 2
+    assert exact['results'][0]['mutations'] == haplotipo
+    assert search('263G 16519C', 'all')['total'] > 2
+    closest = search(haplotipo + ' 100A', 'closest')['results']
+    assert [r['distance'] for r in closest[:2]] == [1, 1]
+    assert closest[2]['distance'] > 1
+    assert client.get(url, {'q': '263X'}).status_code == 400
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_search_matches_brute_force(use_numpy, monkeypatch):
+    if use_numpy:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr('app.index.np', None)
+    index_file(TESTFILE_HAP_FOR, 'FOR')
+    index_file(TESTFILE_HAP_FOR, 'FOR')
+    perfiles = [(p.pk, set(p.mutations.split()))
+                for p in Profile.objects.order_by('id')]
+    with open(TESTFILE_HAP_FOR) as f:
+        consultas = f.read().splitlines()[4::4] + ['263G 16519C', '']
+    for q in consultas:
+        consulta = set(q.split())
+        exact = search_profiles(q, 'FOR', 'exact', 1000)
+        assert [r['id'] for r in exact['results']] == \
+            [pk for pk, m in perfiles if m == consulta]
+        closest = search_profiles(q, 'FOR', 'closest', 5)
+        assert [(r['distance'], r['id']) for r in closest['results']] == \
+            sorted((len(m ^ consulta), pk) for pk, m in perfiles)[:5]
+
+
+@pytest.mark.parametrize('max_distance', [None, 5])
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_distance_matrix(max_distance, use_numpy, tmp_path, monkeypatch):
+    if use_numpy:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr('app.haploutils.np', None)
+    monkeypatch.setattr('app.haploutils.DISTANCE_TILE', 4)
+    outputfile_path = str(tmp_path / 'distances.tsv')
+    manage_haplosearch(TESTFILE_HAP_FOR, outputfile_path, 'FOR', 'H2D',
+                       max_distance=max_distance)
+    with open(TESTFILE_HAP_FOR) as f:
+        lineas = f.read().splitlines()[3:]
+    ids = [linea[1:] for linea in lineas[0::2]]
+    # el haplotipo igual a la referencia se escribe con su identificación
+    muestras = [set(linea.split()) - {'CRS'} for linea in lineas[1::2]]
+    distancias = [[len(a ^ b) for b in muestras] for a in muestras]
+    with open(outputfile_path) as f:
+        filas = [linea.rstrip('\n').split('\t') for linea in f]
+    if max_distance is None:
+        assert filas[0] == ['ID'] + ids
+        assert filas[1:] == [[ids[i]] + [str(d) for d in fila]
+                             for i, fila in enumerate(distancias)]
+    else:
+        assert filas[1:] == [[ids[i], ids[j], str(distancias[i][j])]
+                             for i in range(len(ids))
+                             for j in range(i + 1, len(ids))
+                             if distancias[i][j] <= max_distance]
+
+
+@pytest.mark.parametrize('compression', [GZIP, ZSTD])
+def test_compressed_input_and_output(compression, tmp_path):
+    if compression == ZSTD:
+        pytest.importorskip('zstandard')
+    inputfile_path = str(tmp_path / 'input')
+    outputfile_path = str(tmp_path / 'output')
+    with open(TESTFILE_SEQ, 'rb') as f, \
+            open_compressed(inputfile_path, 'wb', compression) as g:
+        g.write(f.read())
+    manage_haplosearch(
+        inputfile_path, outputfile_path, 'FOR', 'S2H', compression=compression
+    )
+    with open_input(outputfile_path) as f, open(TESTFILE_HAP_FOR) as g:
+        assert f.read() == g.read()
+    assert count_records(inputfile_path) == count_records(TESTFILE_SEQ)
+
+
+@pytest.mark.parametrize('testfile,nomenclature', [
+    (TESTFILE_HAP_POP, 'POP'),
+    (TESTFILE_HAP_FOR, 'FOR'),
+])
+def test_compact_output_expands(testfile, nomenclature, tmp_path):
+    compact_path = str(tmp_path / 'compact')
+    outputfile_path = str(tmp_path / 'output')
+    manage_haplosearch(testfile, compact_path, nomenclature, 'H2S',
+                       compact=True)
+    assert os.path.getsize(compact_path) < os.path.getsize(TESTFILE_SEQ) / 5
+    call_command('expand_compact', compact_path, outputfile_path)
+    assert filecmp.cmp(TESTFILE_SEQ, outputfile_path, shallow=False)
+
+
+@pytest.mark.parametrize('testfile,nomenclature,operation,batch', [
+    (TESTFILE_SEQ, 'FOR', 'S2H', False),
+    (TESTFILE_SEQ, 'FOR', 'S2H', True),
+    (TESTFILE_HAP_FOR, 'FOR', 'H2S', False),
+])
+def test_repeated_records_are_reused(testfile, nomenclature, operation, batch,
+                                     tmp_path):
+    if batch:
+        pytest.importorskip('numpy')
+    # la entrada repite dos veces todos sus registros
+    with open(testfile) as f:
+        lineas = f.readlines()
+    inputfile_path = str(tmp_path / 'input')
+    with open(inputfile_path, 'w') as f:
+        f.writelines(lineas + lineas[3:])
+    outputfile_path = str(tmp_path / 'output')
+    summary = manage_haplosearch(inputfile_path, outputfile_path,
+                                 nomenclature, operation, batch=batch)
+    n = count_records(testfile)
+    assert summary.records == 2 * n
+    assert summary.hits >= n
+    esperado = TESTFILE_HAP_FOR if operation == 'S2H' else TESTFILE_SEQ
+    with open(esperado) as f:
+        lineas = f.readlines()
+    with open(outputfile_path) as f:
+        assert f.readlines() == lineas + lineas[3:]
+
+
+def test_reordered_mutations_are_not_reused(tmp_path):
+    # las mutaciones se aplican en el orden escrito: el mismo conjunto en otro
+    # orden es otro registro
+    inputfile_path = str(tmp_path / 'input')
+    with open(inputfile_path, 'w') as f:
+        f.write('START: 1\n>CRS\nACGTACGTAC\n'
+                '>A\n3iTT 5T 7dG\n>B\n7dG 5T 3iTT\n')
+    outputfile_path = str(tmp_path / 'output')
+    summary = manage_haplosearch(inputfile_path, outputfile_path, 'POP', 'H2S')
+    assert summary.records == 2
+    assert summary.hits == 0
+
+
+def test_reference_cache_skips_alignment(tmp_path, monkeypatch):
+    refcache = ReferenceCache(str(tmp_path / 'refs'))
+    for n in range(2):
+        outputfile_path = str(tmp_path / 'output')
+        manage_haplosearch(TESTFILE_HAP_POP, outputfile_path, 'POP', 'H2S',
+                           refcache=refcache)
+        assert filecmp.cmp(TESTFILE_SEQ, outputfile_path, shallow=False)
+        assert len(os.listdir(refcache.directory)) == 1
+        # la segunda vez la referencia ya no se alinea
+        monkeypatch.setattr(Adn, 'align', None)
+    # los temporales abandonados se borran; los recientes pueden ser de otra
+    # escritura en curso
+    for nombre in ('ref-viejo.tmp', 'ref-nuevo.tmp'):
+        with open(os.path.join(refcache.directory, nombre), 'wb') as f:
+            f.write(b'HSR1')
+    os.utime(os.path.join(refcache.directory, 'ref-viejo.tmp'), (0, 0))
+    # al superar el tamaño máximo se descarta la referencia
+    refcache.max_size = 0
+    refcache.evict()
+    assert os.listdir(refcache.directory) == ['ref-nuevo.tmp']
+
+
+def test_mapped_reader_normalizes_lines(tmp_path):
+    # minúsculas y saltos de línea de Windows dan el mismo resultado
+    with open(TESTFILE_SEQ) as f:
+        lineas = f.read().split('\n')
+    lineas[4] = lineas[4].lower()
+    inputfile_path = str(tmp_path / 'input')
+    with open(inputfile_path, 'w', newline='') as f:
+        f.write('\r\n'.join(lineas))
+    outputfile_path = str(tmp_path / 'output')
+    manage_haplosearch(inputfile_path, outputfile_path, 'FOR', 'S2H')
+    assert filecmp.cmp(TESTFILE_HAP_FOR, outputfile_path, shallow=False)
+    # un símbolo desconocido es un error de sintaxis en su línea
+    lineas[6] = 'X' + lineas[6][1:]
+    with open(inputfile_path, 'w') as f:
+        f.write('\n'.join(lineas))
+    with pytest.raises(HaploException, match=r'\[Line: 7\]'):
+        manage_haplosearch(inputfile_path, outputfile_path, 'FOR', 'S2H')
+
+
+@pytest.mark.parametrize('compression', [None, GZIP])
+def test_wrapped_fasta_input(compression, tmp_path):
+    # secuencias partidas en líneas de 60 columnas y registros separados por
+    # líneas vacías
+    with open(TESTFILE_SEQ) as f:
+        lineas = f.read().splitlines()
+    partidas = lineas[:1]
+    for linea in lineas[1:]:
+        if linea.startswith('>'):
+            partidas += ['', linea]
+        else:
+            partidas += [linea[i:i + 60] for i in range(0, len(linea), 60)]
+    inputfile_path = str(tmp_path / 'input')
+    with open(inputfile_path, 'w') as f:
+        f.write('\n'.join(partidas) + '\n')
+    if compression:
+        with open(inputfile_path, 'rb') as f:
+            contenido = f.read()
+        with open_compressed(inputfile_path, 'wb', compression) as f:
+            f.write(contenido)
+    outputfile_path = str(tmp_path / 'output')
+    manage_haplosearch(inputfile_path, outputfile_path, 'FOR', 'S2H')
+    assert filecmp.cmp(TESTFILE_HAP_FOR, outputfile_path, shallow=False)
+    # los errores siguen indicando la línea del fichero partido
+    partidas[-2] = 'X' + partidas[-2][1:]
+    with open(inputfile_path, 'w') as f:
+        f.write('\n'.join(partidas) + '\n')
+    msg = r'\[Line: %d\]' % (len(partidas) - 1)
+    with pytest.raises(HaploException, match=msg):
+        manage_haplosearch(inputfile_path, outputfile_path, 'FOR', 'S2H')
+
+
+def test_run_stats_by_phase(tmp_path):
+    outputfile_path = str(tmp_path / 'output')
+    stats = RunStats()
+    summary = manage_haplosearch(TESTFILE_HAP_POP, outputfile_path, 'POP',
+                                 'H2S', stats=stats)
+    assert summary.stats is stats
+    fases = stats.as_dict()['phases']
+    assert fases['read']['records'] == fases['convert']['records'] == \
+        count_records(TESTFILE_HAP_POP)
+    assert fases['read']['bytes'] == os.path.getsize(TESTFILE_HAP_POP)
+    assert fases['write']['bytes'] == os.path.getsize(TESTFILE_SEQ)
+    # las fases no se solapan: su suma no supera el total
+    assert 0 < sum(f['wall'] for f in fases.values()) <= stats.wall
+
+
+def test_run_stats_memory_peak(tmp_path):
+    outputfile_path = str(tmp_path / 'output')
+    stats = RunStats(trace_memory=True)
+    manage_haplosearch(TESTFILE_HAP_POP, outputfile_path, 'POP', 'H2S',
+                       stats=stats)
+    assert stats.peak_memory > 0
+    assert not tracemalloc.is_tracing()
+
+
+def test_trace_memory_needs_a_single_job_thread(settings):
+    settings.HAPLOSEARCH_TRACE_MEMORY = True
+    settings.HAPLOSEARCH_JOB_THREADS = 2
+    assert not trace_memory()
+    settings.HAPLOSEARCH_JOB_THREADS = 1
+    assert trace_memory()